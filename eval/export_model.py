@@ -0,0 +1,170 @@
+"""
+Export Wreath with its trained weights as a ready-to-run TorchScript or
+ONNX artifact for a fixed sequence length, strand mode and precision. Load
+it with `load_exported_model` or `load_onnx_session` in `../train/utils.py`,
+or pass it to `get_model_predictions.py --artifact` or
+`../predict/fasta.py --artifact`.
+"""
+from argparse import ArgumentParser
+import json
+import os
+import tempfile
+
+import h5py
+import numpy as np
+import torch
+import yaml
+
+from utils import decode_packbits
+from utils import EXPORT_METADATA
+from utils import init_weights
+from utils import load_exported_model
+from utils import load_model_arch
+from utils import load_model_module
+from utils import load_onnx_session
+from utils import PRECISIONS
+
+
+def synthetic_packbits(path, n_sequences, seq_len, n_fraction=0.01, seed=0):
+    """
+    Write `n_sequences` random one-hot sequences, with about `n_fraction`
+    N bases, to an .h5 file in the packbits layout of the training and
+    evaluation datasets.
+    """
+    rng = np.random.default_rng(seed)
+    sequences = np.eye(4, dtype=np.uint8)[
+        rng.integers(4, size=(n_sequences, seq_len))]
+    sequences[rng.random((n_sequences, seq_len)) < n_fraction] = 1
+    with h5py.File(path, 'w') as write_fh:
+        write_fh.create_dataset(
+            'sequences', data=np.packbits(sequences, axis=-2))
+    return path
+
+
+def check_parity(model, output, export_format, seq_len, dtype,
+                 n_sequences=16, atol=1e-4):
+    """
+    Compare the predictions of the exported artifact at `output` with those
+    of `model` on a small synthetic packbits dataset.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dataset = synthetic_packbits(
+            os.path.join(tmpdir, 'synthetic.h5'), n_sequences, seq_len)
+        with h5py.File(dataset, 'r') as read_fh:
+            batch_seq = decode_packbits(read_fh['sequences'][:])
+    param = next(model.parameters())
+    with torch.no_grad():
+        expected = model(batch_seq.to(device=param.device, dtype=dtype))
+    expected = expected.float().cpu().numpy()
+    if export_format == 'onnx':
+        session, _ = load_onnx_session(output)
+        observed = session.run(
+            None, {'sequence': batch_seq.numpy().astype(np.float32)})[0]
+    else:
+        exported, _ = load_exported_model(output, device=param.device)
+        with torch.no_grad():
+            observed = exported(batch_seq.to(device=param.device, dtype=dtype))
+        observed = observed.float().cpu().numpy()
+    max_diff = float(np.abs(expected - observed).max())
+    print("Parity on {0} synthetic sequences: max abs. difference "
+          "{1:.4g}".format(n_sequences, max_diff))
+    if max_diff > atol:
+        raise RuntimeError(
+            "Exported model deviates from the PyTorch model by {0} "
+            "(atol={1}).".format(max_diff, atol))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--config", help="A required .yaml file with model params")
+    parser.add_argument(
+        "--output", help="Path of the exported model artifact")
+    parser.add_argument(
+        "--seq-len",
+        help="Input sequence length, default is `seq_len` in the config",
+        default=None, type=int)
+    parser.add_argument(
+        "--strand-mode",
+        help="`batched` or `mean` average predictions over both strands "
+             "(in one or two forward passes), `none` predicts the forward "
+             "strand only",
+        choices=["batched", "mean", "none"], default="batched")
+    parser.add_argument(
+        "--precision",
+        help="Precision of the exported weights and inputs; use fp16 with "
+             "--device=cuda and bf16 on CPU",
+        choices=sorted(PRECISIONS.keys()), default="fp32")
+    parser.add_argument(
+        "--fuse",
+        help="Fold Wreath's linear conv pairs before exporting, see "
+             "`fuse_for_inference` in ../model/wreath.py",
+        action="store_true")
+    parser.add_argument(
+        "--device", help="Device to export on", default="cpu")
+    parser.add_argument(
+        "--format",
+        help="`torchscript` (default) or `onnx`, for onnxruntime on CPU",
+        choices=["torchscript", "onnx"], default="torchscript")
+    parser.add_argument(
+        "--check",
+        help="Compare the exported model with the PyTorch model on a small "
+             "synthetic packbits dataset and fail if they differ",
+        action="store_true")
+    args = parser.parse_args()
+    if args.format == 'onnx' and (
+            args.precision != 'fp32' or args.device != 'cpu'):
+        parser.error("--format=onnx exports fp32 models on CPU only")
+
+    setup_args = None
+    with open(args.config) as f:
+        setup_args = yaml.safe_load(f)
+    seq_len = args.seq_len or setup_args.get('seq_len', 2048)
+
+    N_targets = 296
+    model_configs = setup_args['model']
+    if 'class_args' not in model_configs:
+        model_configs['class_args'] = {}
+    model_configs['class_args']['sequence_length'] = seq_len
+    model_configs['class_args']['n_genomic_features'] = N_targets
+    model_configs['non_strand_specific'] = args.strand_mode
+    model = load_model_arch(model_configs)
+
+    checkpoint = torch.load(setup_args['checkpoint'],
+                            map_location=lambda storage, location: storage)
+    model = init_weights(model, checkpoint)
+    model.eval()
+    if args.fuse:
+        model = load_model_module(model_configs).fuse_for_inference(model)
+
+    dtype = PRECISIONS[args.precision][0] or torch.float32
+    model.to(device=args.device, dtype=dtype)
+    metadata = {
+        'seq_len': seq_len,
+        'n_targets': N_targets,
+        'strand_mode': args.strand_mode,
+        'precision': args.precision,
+        'dtype': str(dtype).replace('torch.', ''),
+        'fused': args.fuse,
+        'checkpoint': setup_args['checkpoint'],
+    }
+    if args.format == 'onnx':
+        load_model_module(model_configs).export_onnx(
+            model, args.output, sequence_length=seq_len,
+            metadata={EXPORT_METADATA: json.dumps(metadata)})
+    else:
+        example = torch.full((2, 4, seq_len), 0.25, device=args.device,
+                             dtype=dtype)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+            traced = torch.jit.freeze(traced)
+            # run the frozen graph once so that errors surface at export time
+            traced(example)
+        torch.jit.save(traced, args.output,
+                       _extra_files={EXPORT_METADATA: json.dumps(metadata)})
+    print(args.output)
+    print(metadata)
+
+    if args.check:
+        check_parity(model, args.output, args.format, seq_len, dtype,
+                     atol=1e-4 if dtype is torch.float32 else 1e-2)
@@ -13,9 +13,20 @@ import pandas as pd
 import torch
 import yaml
 
+from pipeline import run_pipeline
+from shards import finalize_shards
+from shards import open_shard
+from shards import shard_path
+from shards import shard_rows
+from utils import autocast
+from utils import decode_packbits
 from utils import init_weights
+from utils import load_exported_model
 from utils import load_model_arch
-from utils import unpackbits_sequence
+from utils import load_onnx_session
+from utils import PackedInputModel
+from utils import PRECISIONS
+from utils import resolve_precision
 
 
 if __name__ == '__main__':
@@ -30,7 +41,83 @@ if __name__ == '__main__':
         "--data-seqlen",
         help=".h5 dataset sequence length, default is 4096bp",
         default=4096, type=int)
+    parser.add_argument(
+        "--precision",
+        help="Run the model under autocast at this precision (bf16 on CPU) "
+             "and store predictions at matching precision, default is fp32",
+        choices=sorted(PRECISIONS.keys()), default="fp32")
+    parser.add_argument(
+        "--precision-report-batches",
+        help="Number of batches also run in fp32 to report the deviation "
+             "of reduced-precision predictions, -1 for all, default is 10",
+        default=10, type=int)
+    parser.add_argument(
+        "--artifact",
+        help="An optional model artifact from `export_model.py` to use "
+             "instead of building the model from the config and checkpoint; "
+             "its sequence length and precision take precedence",
+        default=None)
+    parser.add_argument(
+        "--backend",
+        help="`torch` (default) or `onnxruntime`, which runs an ONNX "
+             "--artifact on CPU",
+        choices=["torch", "onnxruntime"], default="torch")
+    parser.add_argument(
+        "--intra-op-threads",
+        help="Number of threads per operator for the onnxruntime backend, "
+             "default is onnxruntime's",
+        default=None, type=int)
+    parser.add_argument(
+        "--host-decode",
+        help="Decode packbits batches on the host and move float batches to "
+             "the device, instead of moving the packed uint8 batches (32x "
+             "less data than float32) and decoding them on the device; always "
+             "on for the onnxruntime backend",
+        action="store_true")
+    parser.add_argument(
+        "--reader-threads",
+        help="Number of threads reading (and with --host-decode, decoding) "
+             "batches ahead of the model, default is 2",
+        default=2, type=int)
+    parser.add_argument(
+        "--prefetch-batches",
+        help="Number of batches buffered ahead of the model, and of "
+             "prediction batches queued for writing, default is 4",
+        default=4, type=int)
+    parser.add_argument(
+        "--log-every",
+        help="Print the throughput every this many batches, default is 100",
+        default=100, type=int)
+    parser.add_argument(
+        "--num-shards",
+        help="Split the dataset rows into this many contiguous shards, each "
+             "predicted by a separate run (see --shard-index) into its own "
+             "resumable file",
+        default=None, type=int)
+    parser.add_argument(
+        "--shard-index",
+        help="Index of the shard to predict, from 0 to --num-shards - 1",
+        default=None, type=int)
+    parser.add_argument(
+        "--finalize",
+        help="Merge the --num-shards complete shard files into a virtual "
+             "'predictions' dataset of the output file, without predicting",
+        action="store_true")
+    parser.add_argument(
+        "--consolidate",
+        help="With --finalize, copy the shard predictions into the output "
+             "file instead of referencing them",
+        action="store_true")
     args = parser.parse_args()
+    if args.backend == 'onnxruntime' and not args.artifact:
+        parser.error("--backend=onnxruntime requires an ONNX --artifact")
+    if args.num_shards is not None and not args.finalize and (
+            args.shard_index is None or
+            not 0 <= args.shard_index < args.num_shards):
+        parser.error("--num-shards requires a --shard-index in "
+                     "[0, --num-shards)")
+    if args.finalize and args.num_shards is None:
+        parser.error("--finalize requires --num-shards")
 
     setup_args = None
     with open(args.config) as f:
@@ -42,54 +129,156 @@ if __name__ == '__main__':
     else:
         os.makedirs(outdir, exist_ok=True)
     print("Outputting predictions to {0}".format(outdir))
+    outfile = os.path.join(outdir, '{0}.predictions.h5'.format(os.path.basename(args.dataset)))
+    if args.finalize:
+        with h5py.File(args.dataset, 'r') as read_fh:
+            n_rows = len(read_fh['sequences'])
+        print(finalize_shards(outfile, args.num_shards, n_rows,
+                              consolidate=args.consolidate))
+        raise SystemExit
 
     setup_args['dataset'] = args.dataset
     config_out = os.path.join(outdir, os.path.basename(args.config))
     print(config_out)
-    with open(config_out, 'w') as outfile:
-        yaml.dump(setup_args, outfile)
+    with open(config_out, 'w') as config_fh:
+        yaml.dump(setup_args, config_fh)
 
     N_targets = 296
     targets = np.arange(N_targets)
     if 'seq_len' not in setup_args:
         setup_args['seq_len'] = 2048
 
-    model_configs = setup_args['model']
-    if 'class_args' not in model_configs:
-        model_configs['class_args'] = {}
-    # required input arguments to the model architecture class
-    model_configs['class_args']['sequence_length'] = setup_args['seq_len']
-    model_configs['class_args']['n_genomic_features'] = N_targets
-    model = load_model_arch(model_configs)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    input_dtype = torch.float32
+    precision = args.precision
+    if args.backend == 'onnxruntime':
+        device = torch.device('cpu')
+        session, metadata = load_onnx_session(
+            args.artifact, intra_op_threads=args.intra_op_threads)
 
-    checkpoint = torch.load(setup_args['checkpoint'],
-                            map_location=lambda storage, location: storage)
-    model = init_weights(model, checkpoint)
-    model.cuda()
-    model.eval()
+        def model(batch_seq):
+            return torch.from_numpy(session.run(
+                None, {'sequence': np.ascontiguousarray(batch_seq.numpy())})[0])
+    elif args.artifact:
+        model, metadata = load_exported_model(args.artifact, device=device)
+    if args.artifact:
+        print("Loaded {0}: {1}".format(args.artifact, metadata))
+        setup_args['seq_len'] = metadata['seq_len']
+        input_dtype = getattr(torch, metadata['dtype'])
+        # the artifact's precision is fixed at export time
+        precision = metadata['precision']
+    else:
+        model_configs = setup_args['model']
+        if 'class_args' not in model_configs:
+            model_configs['class_args'] = {}
+        # required input arguments to the model architecture class
+        model_configs['class_args']['sequence_length'] = setup_args['seq_len']
+        model_configs['class_args']['n_genomic_features'] = N_targets
+        model = load_model_arch(model_configs)
 
-    outfile = os.path.join(outdir, '{0}.predictions.h5'.format(os.path.basename(args.dataset)))
+        checkpoint = torch.load(setup_args['checkpoint'],
+                                map_location=lambda storage, location: storage)
+        model = init_weights(model, checkpoint)
+        model.to(device)
+        model.eval()
+        precision = resolve_precision(precision, device)
+
+    if args.num_shards is not None:
+        outfile = shard_path(outfile, args.shard_index, args.num_shards)
     print(outfile)
 
     data_seq_len = args.data_seqlen
-    seq_s = data_seq_len // 2 - setup_args['seq_len'] // 2
-    seq_e = data_seq_len // 2 + int(np.ceil(setup_args['seq_len'] / 2.))
+    host_decode = args.host_decode or args.backend == 'onnxruntime'
+    # batches are read or decoded into reused (pinned, on GPU) host buffers
+    batch_size = setup_args['batch_size']
+    if host_decode:
+        buffer_shape = (batch_size, 4, setup_args['seq_len'])
+        buffer_dtype = input_dtype
+    else:
+        model = PackedInputModel(
+            model, setup_args['seq_len'], data_seq_len, dtype=input_dtype)
+        buffer_shape = (batch_size, data_seq_len // 8, 4)
+        buffer_dtype = torch.uint8
+
+    def make_buffer():
+        return torch.empty(buffer_shape, dtype=buffer_dtype,
+                           pin_memory=device.type == 'cuda')
 
-    with h5py.File(args.dataset, 'r') as read_fh, h5py.File(outfile, 'a') as write_fh:
+    store_dtype = np.dtype(PRECISIONS[precision][1])
+    deviation = defaultdict(float)
+    with h5py.File(args.dataset, 'r') as read_fh, \
+            h5py.File(outfile, 'a') as write_fh:
         sequences = read_fh['sequences']
+        start, stop = 0, len(sequences)
+        done = None
+        if args.num_shards is None:
+            if 'predictions' in write_fh:
+                del write_fh['predictions']
+            preds = write_fh.create_dataset(
+                'predictions', (len(sequences), N_targets), dtype=store_dtype)
+        else:
+            # batches marked done by a previous run of this shard are skipped
+            start, stop = shard_rows(
+                len(sequences), args.shard_index, args.num_shards)
+            preds, done = open_shard(
+                write_fh, start, stop, N_targets, batch_size, store_dtype)
+            print("Rows {0}-{1}, {2} of {3} batches already done".format(
+                start, stop, int(done[:].sum()), len(done)))
+
+        def read_batch(s, e, buf):
+            if host_decode:
+                return decode_packbits(
+                    sequences[start + s:start + e], setup_args['seq_len'],
+                    data_seq_len, dtype=input_dtype, out=buf[:e - s])
+            sequences.read_direct(
+                buf.numpy(), np.s_[start + s:start + e], np.s_[0:e - s])
+            return buf[:e - s]
+
+        def compute(bix, s, e, batch_seq):
+            batch_seq = batch_seq.to(device, non_blocking=True)
+            with torch.no_grad(), autocast(
+                    'fp32' if args.artifact else precision, device):
+                batch_preds = model(batch_seq).float().cpu().numpy()
+            batch_preds = batch_preds.astype(store_dtype)
 
-        if 'predictions' in write_fh:
-            del write_fh['predictions']
+            if precision != 'fp32' and not args.artifact and (
+                    args.precision_report_batches < 0 or
+                    bix < args.precision_report_batches):
+                with torch.no_grad():
+                    fp32_preds = model(batch_seq).cpu().numpy()
+                dev = np.abs(batch_preds.astype(np.float32) - fp32_preds)
+                deviation['n'] += len(dev)
+                deviation['max'] = max(deviation['max'], float(dev.max()))
+                deviation['sum'] += float(dev.sum())
+            return batch_preds
 
-        preds = write_fh.create_dataset(
-            'predictions', (len(sequences), N_targets), dtype='float')
+        def write(s, e, batch_preds):
+            preds[s:e] = batch_preds
+            if done is not None:
+                done[s // batch_size] = 1
+                write_fh.flush()
 
-        for ix in range(0, len(sequences), setup_args['batch_size']):
-            s = ix
-            e = min(ix+setup_args['batch_size'], len(sequences))
-            batch_seq = unpackbits_sequence(sequences[s:e], data_seq_len)
-            batch_seq = batch_seq[:, seq_s:seq_e, :]
-            batch_seq = torch.Tensor(batch_seq).cuda()
-            with torch.no_grad():
-                preds[s:e] = model(batch_seq.transpose(1, 2)).data.cpu().numpy()
+        throughput = run_pipeline(
+            stop - start, batch_size, make_buffer, read_batch, compute,
+            write, n_readers=args.reader_threads,
+            prefetch=args.prefetch_batches, log_every=args.log_every,
+            skip=None if done is None else np.nonzero(done[:])[0].tolist())
+        if done is not None:
+            write_fh.attrs['complete'] = bool(done[:].all())
+    print(throughput)
 
+    n_compare = int(deviation['n'])
+    if n_compare:
+        report = {
+            'precision': precision,
+            'device': str(device),
+            'storage_dtype': store_dtype.name,
+            'n_sequences_compared': n_compare,
+            'max_abs_deviation_vs_fp32': deviation['max'],
+            'mean_abs_deviation_vs_fp32': deviation['sum'] / (n_compare * N_targets),
+        }
+        report_out = '{0}.precision.yaml'.format(outfile.rsplit('.', 1)[0])
+        with open(report_out, 'w') as report_fh:
+            yaml.dump(report, report_fh)
+        print(report_out)
+        print(report)
@@ -0,0 +1,173 @@
+"""
+Pipelined batch prediction: reader threads fill a bounded pool of
+preallocated (pinned) batch buffers, the calling thread runs the model on
+the filled batches, and a writer thread stores the predictions, so that
+reading and decoding, compute and writing overlap. h5py serializes calls
+into HDF5, but decoding, the forward pass and host-device copies release the
+GIL and run concurrently with them.
+"""
+import queue
+import threading
+import time
+
+
+_DONE = object()
+
+
+class StageStats(object):
+    """
+    Busy time of each pipeline stage, summed over its threads.
+    """
+
+    def __init__(self, stages):
+        self.busy = {stage: 0. for stage in stages}
+        self.threads = {stage: 1 for stage in stages}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.busy[stage] += seconds
+
+    def report(self, n_rows, wall):
+        """
+        Throughput and the utilization of each stage, i.e. the fraction of
+        the wall time its threads were busy. The stage closest to 1 is the
+        bottleneck.
+        """
+        wall = max(wall, 1e-9)
+        return {
+            'n_sequences': n_rows,
+            'wall_seconds': round(wall, 3),
+            'sequences_per_second': round(n_rows / wall, 1),
+            'utilization': {
+                stage: round(busy / (wall * self.threads[stage]), 3)
+                for stage, busy in self.busy.items()},
+        }
+
+
+def run_pipeline(n_rows, batch_size, make_buffer, read_batch, compute, write,
+                 n_readers=2, prefetch=4, log_every=None, skip=None):
+    """
+    Predict `n_rows` rows in batches of `batch_size`.
+
+    Parameters
+    ----------
+    n_rows : int
+    batch_size : int
+    make_buffer : callable
+        `make_buffer()` returns a new batch buffer; `n_readers + prefetch`
+        buffers are reused throughout.
+    read_batch : callable
+        `read_batch(s, e, buf)` reads rows `[s, e)` into `buf` and returns
+        the batch to predict (e.g. a view of `buf`). Runs in the reader
+        threads.
+    compute : callable
+        `compute(bix, s, e, batch)` returns the predictions of batch `bix`
+        as a host array; `buf` is reused once it returns, so it must be done
+        with the batch (e.g. by synchronizing on the device output). Runs in
+        the calling thread, in no particular batch order.
+    write : callable
+        `write(s, e, predictions)` stores the predictions. Runs in the
+        writer thread.
+    n_readers : int
+        Number of reader threads.
+    prefetch : int
+        Number of batches read ahead of compute (and predictions queued for
+        writing) beyond one per reader.
+    log_every : int or None
+        Print the throughput every `log_every` batches.
+    skip : container of int or None
+        Indices of batches not to predict, e.g. those already written.
+
+    Returns
+    -------
+    dict
+        Throughput and stage utilization, see `StageStats.report`.
+    """
+    skip = set() if skip is None else set(skip)
+    tasks = iter([(bix, s, min(s + batch_size, n_rows))
+                  for bix, s in enumerate(range(0, n_rows, batch_size))
+                  if bix not in skip])
+    task_lock = threading.Lock()
+    stop = threading.Event()
+    free = queue.Queue()
+    for _ in range(n_readers + prefetch):
+        free.put(make_buffer())
+    filled = queue.Queue()
+    pending = queue.Queue(maxsize=n_readers + prefetch)
+    stats = StageStats(('read', 'compute', 'write'))
+    stats.threads['read'] = n_readers
+    errors = []
+
+    def reader():
+        try:
+            while not stop.is_set():
+                with task_lock:
+                    task = next(tasks, None)
+                if task is None:
+                    break
+                buf = free.get()
+                if buf is _DONE:
+                    break
+                bix, s, e = task
+                t0 = time.perf_counter()
+                batch = read_batch(s, e, buf)
+                stats.add('read', time.perf_counter() - t0)
+                filled.put((bix, s, e, buf, batch))
+        except BaseException as err:
+            errors.append(err)
+        finally:
+            filled.put(_DONE)
+
+    def writer():
+        while True:
+            item = pending.get()
+            if item is _DONE:
+                break
+            if errors:
+                continue
+            try:
+                t0 = time.perf_counter()
+                write(*item)
+                stats.add('write', time.perf_counter() - t0)
+            except BaseException as err:
+                errors.append(err)
+
+    readers = [threading.Thread(target=reader, daemon=True)
+               for _ in range(n_readers)]
+    write_thread = threading.Thread(target=writer, daemon=True)
+    start = time.perf_counter()
+    for thread in readers + [write_thread]:
+        thread.start()
+
+    n_done = 0
+    n_batches = 0
+    n_readers_done = 0
+    try:
+        while n_readers_done < n_readers and not errors:
+            item = filled.get()
+            if item is _DONE:
+                n_readers_done += 1
+                continue
+            bix, s, e, buf, batch = item
+            t0 = time.perf_counter()
+            predictions = compute(bix, s, e, batch)
+            stats.add('compute', time.perf_counter() - t0)
+            free.put(buf)
+            pending.put((s, e, predictions))
+            n_done += e - s
+            n_batches += 1
+            if log_every and n_batches % log_every == 0:
+                print("{0} sequences, {1:.1f} sequences/s".format(
+                    n_done, n_done / (time.perf_counter() - start)))
+    finally:
+        stop.set()
+        for _ in readers:
+            free.put(_DONE)
+        pending.put(_DONE)
+        write_thread.join()
+        for thread in readers:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return stats.report(n_done, time.perf_counter() - start)
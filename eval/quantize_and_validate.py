@@ -0,0 +1,186 @@
+"""
+Quantize Wreath to int8 for CPU inference and compare it with the fp32
+model on a held-out HDF5 dataset of packbits sequences and targets, e.g.
+the test dataset used by `get_model_predictions.py`.
+"""
+from argparse import ArgumentParser
+import os
+from time import time
+
+import h5py
+import numpy as np
+import pandas as pd
+from scipy.stats import pearsonr
+from scipy.stats import spearmanr
+import torch
+import yaml
+
+from utils import decode_packbits
+from utils import init_weights
+from utils import load_model_arch
+from utils import load_model_module
+
+
+def get_batches(sequences, s, e, batch_size, data_seq_len, seq_len):
+    for ix in range(s, e, batch_size):
+        yield decode_packbits(
+            sequences[ix:min(ix + batch_size, e)], seq_len, data_seq_len)
+
+
+def predict(model, batches):
+    preds = []
+    start = time()
+    with torch.no_grad():
+        for batch_seq in batches:
+            preds.append(model(batch_seq).numpy())
+    return np.vstack(preds), time() - start
+
+
+def track_correlations(preds, targets):
+    spearman = np.full(targets.shape[1], np.nan)
+    pearson = np.full(targets.shape[1], np.nan)
+    for t in range(targets.shape[1]):
+        keep = ~np.isnan(targets[:, t])
+        if keep.sum() < 2:
+            continue
+        spearman[t] = spearmanr(preds[keep, t], targets[keep, t])[0]
+        pearson[t] = pearsonr(preds[keep, t], targets[keep, t])[0]
+    return spearman, pearson
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--config", help="A required .yaml file with model params")
+    parser.add_argument(
+        "--dataset",
+        help="A required .h5 file with `sequences` and `targets`")
+    parser.add_argument(
+        "--outdir", help="An optional output directory path", default=None)
+    parser.add_argument(
+        "--data-seqlen",
+        help=".h5 dataset sequence length, default is 4096bp",
+        default=4096, type=int)
+    parser.add_argument(
+        "--n-calibrate",
+        help="Number of sequences (from the start of the dataset) used to "
+             "calibrate activation ranges, default is 2048",
+        default=2048, type=int)
+    parser.add_argument(
+        "--n-validate",
+        help="Number of sequences following the calibration sequences used "
+             "for validation, default is 32000",
+        default=32000, type=int)
+    parser.add_argument(
+        "--targets-info",
+        help="Track annotations, one row per target",
+        default="../model/wreath_targets_cleaned.tsv")
+    parser.add_argument(
+        "--threads", help="Number of CPU threads", default=None, type=int)
+    parser.add_argument(
+        "--backend", help="Quantized engine, e.g. x86 or qnnpack",
+        default="x86")
+    parser.add_argument(
+        "--save-quantized",
+        help="Optional path to save the traced quantized model to",
+        default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    setup_args = None
+    with open(args.config) as f:
+        setup_args = yaml.safe_load(f)
+
+    outdir = args.outdir
+    if args.outdir is None:
+        outdir, _ = os.path.split(setup_args['checkpoint'])
+    else:
+        os.makedirs(outdir, exist_ok=True)
+
+    N_targets = 296
+    if 'seq_len' not in setup_args:
+        setup_args['seq_len'] = 2048
+
+    model_configs = setup_args['model']
+    if 'class_args' not in model_configs:
+        model_configs['class_args'] = {}
+    model_configs['class_args']['sequence_length'] = setup_args['seq_len']
+    model_configs['class_args']['n_genomic_features'] = N_targets
+    # quantization needs the bare Wreath, which averages the two strands
+    # itself ('batched') in place of selene's NonStrandSpecific 'mean'
+    strand_mode = model_configs.get('non_strand_specific', 'mean')
+    if strand_mode == 'mean':
+        strand_mode = 'batched'
+    if strand_mode not in ('batched', 'none'):
+        raise ValueError(
+            "non_strand_specific: {0} cannot be quantized, use mean, "
+            "batched or none".format(strand_mode))
+    model_configs['non_strand_specific'] = strand_mode
+    model = load_model_arch(model_configs)
+
+    checkpoint = torch.load(setup_args['checkpoint'],
+                            map_location=lambda storage, location: storage)
+    model = init_weights(model, checkpoint)
+    model.eval()
+
+    data_seq_len = args.data_seqlen
+    batch_size = setup_args['batch_size']
+
+    with h5py.File(args.dataset, 'r') as read_fh:
+        sequences = read_fh['sequences']
+        n_cal = min(args.n_calibrate, len(sequences))
+        n_val = min(args.n_validate, len(sequences) - n_cal)
+        print("Calibrating on {0} sequences, validating on {1}".format(
+            n_cal, n_val))
+
+        qmodel = load_model_module(model_configs).quantize_for_cpu(
+            model,
+            get_batches(sequences, 0, n_cal, batch_size,
+                        data_seq_len, setup_args['seq_len']),
+            backend=args.backend)
+
+        fp32_preds, fp32_time = predict(
+            model, get_batches(sequences, n_cal, n_cal + n_val, batch_size,
+                               data_seq_len, setup_args['seq_len']))
+        int8_preds, int8_time = predict(
+            qmodel, get_batches(sequences, n_cal, n_cal + n_val, batch_size,
+                                data_seq_len, setup_args['seq_len']))
+        targets = read_fh['targets'][n_cal:n_cal + n_val].astype(float)
+
+    fp32_spearman, fp32_pearson = track_correlations(fp32_preds, targets)
+    int8_spearman, int8_pearson = track_correlations(int8_preds, targets)
+
+    report = pd.read_csv(args.targets_info, sep='\t')
+    report = report[['Source', 'Cell Type']].copy()
+    report['spearman_fp32'] = fp32_spearman
+    report['spearman_int8'] = int8_spearman
+    report['spearman_delta'] = int8_spearman - fp32_spearman
+    report['pearson_fp32'] = fp32_pearson
+    report['pearson_int8'] = int8_pearson
+    report['pearson_delta'] = int8_pearson - fp32_pearson
+    report_out = os.path.join(
+        outdir, '{0}.int8_validation.tsv'.format(
+            os.path.basename(args.dataset)))
+    report.to_csv(report_out, sep='\t', index=False)
+    print(report_out)
+
+    abs_diff = np.abs(int8_preds - fp32_preds)
+    print("fp32: {0:.1f} seqs/s, int8: {1:.1f} seqs/s ({2:.2f}x)".format(
+        n_val / fp32_time, n_val / int8_time, fp32_time / int8_time))
+    print("Prediction abs. difference: max {0:.4g}, mean {1:.4g}".format(
+        abs_diff.max(), abs_diff.mean()))
+    for metric in ['spearman', 'pearson']:
+        delta = report['{0}_delta'.format(metric)]
+        print("{0} delta across tracks: mean {1:.4g}, min {2:.4g}, "
+              "max {3:.4g}".format(
+                  metric, np.nanmean(delta), np.nanmin(delta),
+                  np.nanmax(delta)))
+
+    if args.save_quantized:
+        example = torch.zeros((2, 4, setup_args['seq_len']))
+        with torch.no_grad():
+            traced = torch.jit.trace(qmodel, example)
+        torch.jit.save(traced, args.save_quantized)
+        print(args.save_quantized)
@@ -0,0 +1,121 @@
+"""
+Sharded, resumable prediction output for `get_model_predictions.py`. The
+rows of a dataset are split into contiguous shards; each shard is predicted
+into its own file, with a per-batch completion marker so that a restarted
+worker skips the batches it already wrote, and `finalize_shards` merges the
+shard files into an h5py virtual dataset (or a consolidated dataset) in the
+original row order.
+"""
+import os
+
+import h5py
+import numpy as np
+
+
+def shard_rows(n_rows, shard_index, num_shards):
+    """
+    The rows `[start, stop)` of shard `shard_index` of `num_shards`.
+    """
+    return (n_rows * shard_index // num_shards,
+            n_rows * (shard_index + 1) // num_shards)
+
+
+def shard_path(outfile, shard_index, num_shards):
+    """
+    `<outfile>.shard-<index>-of-<num_shards>.h5`, next to `outfile`.
+    """
+    return '{0}.shard-{1:03d}-of-{2:03d}.h5'.format(
+        outfile.rsplit('.', 1)[0], shard_index, num_shards)
+
+
+def open_shard(fh, start, stop, n_targets, batch_size, dtype):
+    """
+    Set up the open shard file `fh` for rows `[start, stop)`. Returns its
+    'predictions' dataset and its 'done' dataset, which marks the
+    completed batches. An existing shard is only resumed if it was created
+    with the same rows, batch size and dtype; otherwise it is started over.
+    """
+    n_batches = -(-(stop - start) // batch_size)
+    resume = ('predictions' in fh and 'done' in fh and
+              fh.attrs.get('start') == start and
+              fh.attrs.get('stop') == stop and
+              fh.attrs.get('batch_size') == batch_size and
+              fh['predictions'].dtype == dtype)
+    if not resume:
+        for name in list(fh.keys()):
+            del fh[name]
+        fh.create_dataset('predictions', (stop - start, n_targets),
+                          dtype=dtype)
+        fh.create_dataset('done', (n_batches,), dtype=np.uint8)
+        fh.attrs['start'] = start
+        fh.attrs['stop'] = stop
+        fh.attrs['batch_size'] = batch_size
+        fh.attrs['complete'] = False
+        fh.flush()
+    return fh['predictions'], fh['done']
+
+
+def finalize_shards(outfile, num_shards, n_rows, consolidate=False):
+    """
+    Write the 'predictions' dataset of `outfile` from the `num_shards`
+    complete shard files: a virtual dataset referencing them, or with
+    `consolidate` a regular dataset holding a copy of their predictions
+    (after which the shard files can be removed). The shards must cover
+    the `n_rows` rows of the dataset exactly; otherwise a `ValueError`
+    lists the missing rows.
+    """
+    shards, missing = [], []
+    for ix in range(num_shards):
+        path = shard_path(outfile, ix, num_shards)
+        if not os.path.exists(path):
+            missing.append(path)
+            continue
+        with h5py.File(path, 'r') as fh:
+            if not fh.attrs.get('complete', False):
+                raise ValueError(
+                    "Shard {0} is not complete ({1} of {2} batches)".format(
+                        path, int(fh['done'][:].sum()), len(fh['done'])))
+            shards.append((path, int(fh.attrs['start']),
+                           int(fh.attrs['stop']), fh['predictions'].shape,
+                           fh['predictions'].dtype))
+    shards.sort(key=lambda shard: shard[1])
+    gaps, covered = [], 0
+    for path, start, stop, _, _ in shards:
+        if start < covered or stop > n_rows:
+            raise ValueError(
+                "Shard {0} (rows {1}-{2}) overlaps another shard or is "
+                "outside of the {3} rows of the dataset".format(
+                    path, start, stop, n_rows))
+        if start > covered:
+            gaps.append((covered, start))
+        covered = stop
+    if covered < n_rows:
+        gaps.append((covered, n_rows))
+    if gaps:
+        raise ValueError(
+            "Shards do not cover rows {0} of the {1} rows of the "
+            "dataset{2}".format(
+                ', '.join('{0}-{1}'.format(*gap) for gap in gaps), n_rows,
+                '; missing shard files: {0}'.format(', '.join(missing))
+                if missing else ''))
+    n_targets = shards[0][3][1]
+    dtype = shards[0][4]
+
+    with h5py.File(outfile, 'a') as write_fh:
+        if 'predictions' in write_fh:
+            del write_fh['predictions']
+        if consolidate:
+            preds = write_fh.create_dataset(
+                'predictions', (n_rows, n_targets), dtype=dtype)
+            for path, start, stop, _, _ in shards:
+                with h5py.File(path, 'r') as fh:
+                    preds[start:stop] = fh['predictions'][:]
+        else:
+            layout = h5py.VirtualLayout(shape=(n_rows, n_targets),
+                                        dtype=dtype)
+            for path, start, stop, shape, _ in shards:
+                # relative to the directory of `outfile`
+                layout[start:stop] = h5py.VirtualSource(
+                    os.path.basename(path), 'predictions', shape=shape)
+            write_fh.create_virtual_dataset('predictions', layout)
+    return outfile
@@ -1,11 +1,10 @@
 import os, argparse, numpy as np, h5py, torch, sys
-from selene_sdk.utils import NonStrandSpecific
 
 # Add paths to import Wreath model and utilities
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'model'))
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'train'))
 from wreath import Wreath
-from utils import init_weights, unpackbits_sequence
+from utils import init_weights, decode_packbits
 
 # tangermeme
 from tangermeme.deep_lift_shap import deep_lift_shap
@@ -20,8 +19,9 @@ def disable_inplace_relu(model):
 
 def load_model(checkpoint_path, seq_len, n_targets, device, use_rc=False):
     ckpt = torch.load(checkpoint_path, map_location=lambda storage, location: storage)
-    base = Wreath(sequence_length=seq_len, n_genomic_features=n_targets)
-    model = NonStrandSpecific(base) if use_rc else base
+    # use_rc: average each sequence with its reverse complement in one pass
+    model = Wreath(sequence_length=seq_len, n_genomic_features=n_targets,
+                   strand_average=use_rc)
     model = init_weights(model, ckpt).to(device).eval()
 
     model = disable_inplace_relu(model)
@@ -118,7 +118,6 @@ def main():
     if args.indices: seqs = seqs[np.load(args.indices)]
     N = len(seqs)
     L_full, L = args.seq_len, args.model_seq_len
-    c, h = L_full//2, L//2
 
     # targets
     if args.targets_file and os.path.exists(args.targets_file):
@@ -147,9 +146,8 @@ def main():
             B = args.batch_size
             for s in range(0,N,B):
                 e = min(N,s+B)
-                b = unpackbits_sequence(seqs[s:e], L_full)            # [b,Lfull,4]
-                b = b[:, c-h:c+h, :].transpose(0,2,1).astype(np.float32)
-                tmp[s:e] = b
+                decode_packbits(seqs[s:e], L, L_full,
+                                out=torch.from_numpy(tmp[s:e]))  # [b,4,L]
             del tmp
             arr = np.memmap(os.path.join(args.outdir,'ohe.tmp.memmap'),
                             dtype=np.float32, mode='r', shape=(N,4,L))
@@ -173,9 +171,7 @@ def main():
 
         for s in range(0, N, args.examples_per_call):
             e = min(N, s+args.examples_per_call)
-            b = unpackbits_sequence(seqs[s:e], L_full)                 # [b,Lfull,4]
-            b = b[:, c-h:c+h, :].transpose(0,2,1).astype(np.float32)   # [b,4,L]
-            X = torch.from_numpy(b)  # CPU; tangermeme moves pairs to device
+            X = decode_packbits(seqs[s:e], L, L_full)  # [b,4,L] CPU; tangermeme moves pairs to device
 
             if ref_mode == "function":
                 refs = refs_obj  # function reference
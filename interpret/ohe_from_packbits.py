@@ -1,9 +1,9 @@
 # prepare_ohe_from_packbits.py
-import os, argparse, numpy as np, sys
+import os, argparse, numpy as np, sys, torch
 
 # Add path to import utilities
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'train'))
-from utils import unpackbits_sequence
+from packbits import decode_packbits
 
 def main():
     ap = argparse.ArgumentParser()
@@ -20,7 +20,6 @@ def main():
         seqs = seqs[np.load(args.indices)]
     N = len(seqs)
     L_full, L = args.seq_len, args.model_seq_len
-    center, half = L_full // 2, L // 2
 
     os.makedirs(os.path.dirname(args.out), exist_ok=True)
     memmap_path = os.path.join(os.path.dirname(args.out), "ohe.tmp.memmap")
@@ -29,10 +28,8 @@ def main():
     B = args.batch_size
     for s in range(0, N, B):
         e = min(N, s + B)
-        b = unpackbits_sequence(seqs[s:e], L_full)    # [b, L_full, 4]
-        b = b[:, center - half:center + half, :]      # [b, L, 4]
-        b = b.transpose(0, 2, 1).astype(np.float32)   # [b, 4, L]
-        ohe[s:e] = b
+        # [b, 4, L] float32, decoded straight into the memmap
+        decode_packbits(seqs[s:e], L, L_full, out=torch.from_numpy(ohe[s:e]))
     del ohe
 
     arr = np.memmap(memmap_path, dtype=np.float32, mode="r", shape=(N, 4, L))
@@ -1,31 +1,95 @@
+import copy
+import inspect
+
 import numpy as np
-from scipy.interpolate import splev
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from time import time
 
 
-def bs(x, df=None, knots=None, degree=3, intercept=False):
+def bspline_basis(x, knots, degree=3):
     """
-    df : int
-        The number of degrees of freedom to use for this spline. The
-        return value will have this many columns. You must specify at least
-        one of `df` and `knots`.
-    knots : list(float)
-        The interior knots of the spline. If unspecified, then equally
-        spaced quantiles of the input data are used. You must specify at least
-        one of `df` and `knots`.
+    Evaluate every B-spline basis function of the given knot vector at the
+    points `x` with the Cox-de Boor recursion, vectorized over points and
+    basis functions. Agrees with `scipy.interpolate.splev` called with a
+    one-hot coefficient vector per basis function, including at the right
+    boundary knot, which belongs to the last non-empty knot interval.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Points of shape (n,) within the range of `knots`.
+    knots : numpy.ndarray
+        Sorted knot vector of length m.
     degree : int
-        The degree of the piecewise polynomial. Default is 3 for cubic splines.
-    intercept : bool
-        If `True`, the resulting spline basis will span the intercept term
-        (i.e. the constant function). If `False` (the default) then this
-        will not be the case, which is useful for avoiding overspecification
-        in models that include multiple spline terms and/or an intercept term.
 
+    Returns
+    -------
+    numpy.ndarray
+        Basis matrix of shape (n, m - degree - 1).
     """
+    x = np.asarray(x, dtype=float)[:, None]
+    t = np.asarray(knots, dtype=float)
+    basis = ((t[:-1] <= x) & (x < t[1:])).astype(float)
+    last = np.nonzero(t[:-1] < t[1:])[0][-1]
+    basis[x[:, 0] >= t[last + 1], last] = 1.0
+    for d in range(1, degree + 1):
+        left_den = t[d:-1] - t[:-d - 1]
+        right_den = t[d + 1:] - t[1:-d]
+        left = np.divide(x - t[:-d - 1], left_den,
+                         out=np.zeros((x.shape[0], len(left_den))),
+                         where=left_den != 0)
+        right = np.divide(t[d + 1:] - x, right_den,
+                          out=np.zeros((x.shape[0], len(right_den))),
+                          where=right_den != 0)
+        basis = left * basis[:, :-1] + right * basis[:, 1:]
+    return basis
+
 
+def bspline_basis_torch(x, knots, degree=3):
+    """
+    `bspline_basis` for tensors: evaluates the basis on `x`'s device and in
+    its dtype (use float64 for a basis that matches the NumPy version).
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Points of shape (n,) within the range of `knots`.
+    knots : torch.Tensor
+        Sorted knot vector of length m.
+    degree : int
+
+    Returns
+    -------
+    torch.Tensor
+        Basis matrix of shape (n, m - degree - 1).
+    """
+    x = x[:, None]
+    t = knots.to(x)
+    basis = ((t[:-1] <= x) & (x < t[1:])).to(x.dtype)
+    last = torch.nonzero(t[:-1] < t[1:])[-1, 0]
+    basis[x[:, 0] >= t[last + 1], last] = 1.0
+    for d in range(1, degree + 1):
+        left_den = t[d:-1] - t[:-d - 1]
+        right_den = t[d + 1:] - t[1:-d]
+        left = torch.where(
+            left_den != 0,
+            (x - t[:-d - 1]) / torch.where(left_den != 0, left_den,
+                                           torch.ones_like(left_den)),
+            torch.zeros_like(left_den))
+        right = torch.where(
+            right_den != 0,
+            (t[d + 1:] - x) / torch.where(right_den != 0, right_den,
+                                          torch.ones_like(right_den)),
+            torch.zeros_like(right_den))
+        basis = left * basis[:, :-1] + right * basis[:, 1:]
+    return basis
+
+
+def _bs_knots(x, df=None, knots=None, degree=3, intercept=False):
+    """The full, sorted knot vector used by `bs`."""
     order = degree + 1
     inner_knots = []
     if df is not None and knots is None:
@@ -46,65 +110,304 @@ def bs(x, df=None, knots=None, degree=3, intercept=False):
         ([np.min(x), np.max(x)] * order, inner_knots))
 
     all_knots.sort()
+    return all_knots
+
 
-    n_basis = len(all_knots) - (degree + 1)
-    basis = np.empty((x.shape[0], n_basis), dtype=float)
+def bs(x, df=None, knots=None, degree=3, intercept=False):
+    """
+    df : int
+        The number of degrees of freedom to use for this spline. The
+        return value will have this many columns. You must specify at least
+        one of `df` and `knots`.
+    knots : list(float)
+        The interior knots of the spline. If unspecified, then equally
+        spaced quantiles of the input data are used. You must specify at least
+        one of `df` and `knots`.
+    degree : int
+        The degree of the piecewise polynomial. Default is 3 for cubic splines.
+    intercept : bool
+        If `True`, the resulting spline basis will span the intercept term
+        (i.e. the constant function). If `False` (the default) then this
+        will not be the case, which is useful for avoiding overspecification
+        in models that include multiple spline terms and/or an intercept term.
 
-    for i in range(n_basis):
-        coefs = np.zeros((n_basis,))
-        coefs[i] = 1
-        basis[:, i] = splev(x, (all_knots, coefs, degree))
+    """
+    all_knots = _bs_knots(x, df=df, knots=knots, degree=degree,
+                          intercept=intercept)
+    basis = bspline_basis(x, all_knots, degree)
 
     if not intercept:
         basis = basis[:, 1:]
     return basis
 
 
-def spline_factory(n, df, log=False):
-    if log:
-        dist = np.array(np.arange(n) - n/2.0)
-        dist = np.log(np.abs(dist) + 1) * ( 2*(dist>0)-1)
-        n_knots = df - 4
-        knots = np.linspace(np.min(dist),np.max(dist),n_knots+2)[1:-1]
-        return torch.from_numpy(bs(
-            dist, knots=knots, intercept=True)).float()
-    else:
-        dist = np.arange(n)
-        return torch.from_numpy(bs(
-            dist, df=df, intercept=True)).float()
+# (n, df, log, scaled, dtype, device) -> spline basis, shared process-wide
+_SPLINE_BASIS_CACHE = {}
+
+
+def spline_factory(n, df, log=False, scaled=False, dtype=torch.float32,
+                   device=None):
+    """
+    The (n, df) cubic B-spline basis used by `BSplineTransformation`,
+    divided by `n` if `scaled`. Bases are built once per process for each
+    (n, df, log, scaled, dtype, device) and the cached tensor is returned
+    on later calls, so it must not be modified in place.
+    """
+    device = torch.device('cpu') if device is None else torch.device(device)
+    key = (n, df, log, scaled, dtype, device)
+    if key not in _SPLINE_BASIS_CACHE:
+        if log:
+            dist = np.array(np.arange(n) - n/2.0)
+            dist = np.log(np.abs(dist) + 1) * ( 2*(dist>0)-1)
+            n_knots = df - 4
+            knots = np.linspace(np.min(dist),np.max(dist),n_knots+2)[1:-1]
+            all_knots = _bs_knots(dist, knots=knots, intercept=True)
+        else:
+            dist = np.arange(n)
+            all_knots = _bs_knots(dist, df=df, intercept=True)
+        basis = bspline_basis_torch(
+            torch.from_numpy(dist.astype(np.float64)),
+            torch.from_numpy(all_knots.astype(np.float64)))
+        if scaled:
+            basis = basis / n
+        _SPLINE_BASIS_CACHE[key] = basis.to(device=device, dtype=dtype)
+    return _SPLINE_BASIS_CACHE[key]
 
 
 class BSplineTransformation(nn.Module):
+    """
+    Projects the last (spatial) dimension of the input onto a cubic B-spline
+    basis. Bases are kept as non-persistent buffers named
+    `spline_tr_<length>`, one per input length seen, so that a single
+    instance serves several sequence lengths and its bases follow
+    `.to(device, dtype)` and `DataParallel` replication. Bases for
+    `spatial_dims` are registered up front, e.g. to avoid building them
+    inside replicas on the first batch; other lengths are added lazily.
+    """
 
-    def __init__(self, degrees_of_freedom, log=False, scaled=False):
+    def __init__(self, degrees_of_freedom, log=False, scaled=False,
+                 spatial_dims=()):
         super(BSplineTransformation, self).__init__()
-        self._spline_tr = None
         self._log = log
         self._scaled = scaled
         self._df = degrees_of_freedom
+        for spatial_dim in spatial_dims:
+            self.register_buffer(
+                'spline_tr_{0}'.format(spatial_dim),
+                self.basis(spatial_dim), persistent=False)
+
+    def basis(self, spatial_dim, dtype=torch.float32, device=None):
+        """The (spatial_dim, degrees_of_freedom) spline basis matrix."""
+        return spline_factory(spatial_dim, self._df, log=self._log,
+                              scaled=self._scaled, dtype=dtype, device=device)
 
     def forward(self, input):
-        if self._spline_tr is None:
-            spatial_dim = input.size()[-1]
-            self._spline_tr = spline_factory(spatial_dim, self._df, log=self._log)
-            if self._scaled:
-                self._spline_tr = self._spline_tr / spatial_dim
-            if input.is_cuda:
-                self._spline_tr = self._spline_tr.cuda()
+        name = 'spline_tr_{0}'.format(input.size()[-1])
+        spline_tr = self._buffers.get(name)
+        if spline_tr is None:
+            spline_tr = self.basis(input.size()[-1], dtype=input.dtype,
+                                   device=input.device)
+            self.register_buffer(name, spline_tr, persistent=False)
+        if spline_tr.device != input.device or spline_tr.dtype != input.dtype:
+            spline_tr = spline_tr.to(device=input.device, dtype=input.dtype)
+
+        return  torch.matmul(input, spline_tr)
 
-        return  torch.matmul(input, self._spline_tr)
 
+class FusedSplineHead(nn.Module):
+    """
+    Inference-only replacement for `Wreath.head` in which the B-spline
+    basis is folded into the weight of the first classifier `Linear`, so
+    the (N, C, L) trunk output is contracted in a single matrix product
+    with no intermediate spline output.
+
+    The folded weight has `C * L` rather than `C * df` columns, so folding
+    only saves multiply-adds when `L * n_out < df * (L + n_out)`, i.e. for
+    short inputs or few output features (`folds`); other input lengths use
+    the spline transformation and classifier as is. Folded weights are
+    kept as non-persistent buffers named `folded_weight_<length>`, like the
+    spline bases of `BSplineTransformation`, so they follow
+    `.to(device, dtype)`. Weights are captured when the folded matrix is
+    first built, so rebuild the head after changing the model's parameters.
+
+    Parameters
+    ----------
+    spline_tr : torch.nn.Sequential
+        `Wreath.spline_tr`; any `Dropout` is ignored.
+    classifier : torch.nn.Sequential
+        `Wreath.classifier`, whose first layer is a `Linear`.
+    """
+
+    def __init__(self, spline_tr, classifier):
+        super(FusedSplineHead, self).__init__()
+        self.spline = [m for m in spline_tr
+                       if isinstance(m, BSplineTransformation)][0]
+        self.linear = classifier[0]
+        self.rest = classifier[1:]
+
+    def folds(self, spatial_dim):
+        """Whether folding saves multiply-adds at input length
+        `spatial_dim`."""
+        df = self.spline._df
+        n_out = self.linear.out_features
+        return spatial_dim * n_out < df * (spatial_dim + n_out)
+
+    def folded_weight(self, spatial_dim, dtype=torch.float32, device=None):
+        """The (n_out, C * spatial_dim) folded weight matrix."""
+        name = 'folded_weight_{0}'.format(spatial_dim)
+        weight = self._buffers.get(name)
+        if weight is None:
+            basis = self.spline.basis(
+                spatial_dim, dtype=torch.float64,
+                device=self.linear.weight.device)
+            weight = self.linear.weight.detach().double()
+            weight = weight.view(weight.size(0), -1, basis.size(1))
+            folded = torch.einsum('ock,lk->ocl', weight, basis)
+            weight = folded.reshape(folded.size(0), -1).to(
+                self.linear.weight.dtype).contiguous()
+            self.register_buffer(name, weight, persistent=False)
+        if weight.device != device or weight.dtype != dtype:
+            weight = weight.to(device=device, dtype=dtype)
+        return weight
+
+    def forward(self, input):
+        # int() keeps the buffer name a plain length when traced for export
+        spatial_dim = int(input.size(-1))
+        if self.folds(spatial_dim):
+            output = F.linear(
+                input.reshape(input.size(0), -1),
+                self.folded_weight(spatial_dim, input.dtype, input.device),
+                self.linear.bias)
+        else:
+            output = self.linear(
+                self.spline(input).reshape(input.size(0), -1))
+        return self.rest(output)
+
+
+class FusedConvPair(nn.Module):
+    """
+    Two stacked `Conv1d` layers with no nonlinearity in between, folded into
+    a single convolution of kernel size `k1 + k2 - 1` for inference.
+
+    The original pair zero-pads its intermediate output, which the fused
+    convolution cannot reproduce, so the outermost `padding` columns on
+    each side are recomputed with the original layers.
+
+    Parameters
+    ----------
+    first : torch.nn.Conv1d
+    second : torch.nn.Conv1d
+        Stride 1, undilated, ungrouped convolutions with zero "same"
+        padding, applied as `second(first(x))`.
+    """
+
+    def __init__(self, first, second):
+        super(FusedConvPair, self).__init__()
+        for conv in (first, second):
+            k = conv.kernel_size[0]
+            if (conv.stride[0] != 1 or conv.dilation[0] != 1 or
+                    conv.groups != 1 or conv.padding_mode != 'zeros' or
+                    conv.padding[0] * 2 != k - 1):
+                raise ValueError(
+                    "Only stride 1, undilated, ungrouped 'same' "
+                    "convolutions can be fused: {0}".format(conv))
+        self.first = first
+        self.second = second
+
+        w1 = first.weight.detach().double()
+        w2 = second.weight.detach().double()
+        k1, k2 = w1.size(-1), w2.size(-1)
+        weight = w1.new_zeros((w2.size(0), w1.size(1), k1 + k2 - 1))
+        for b in range(k2):
+            weight[:, :, b:b + k1] += torch.einsum(
+                'om,mia->oia', w2[:, :, b], w1)
+        bias = w2.sum(-1) @ first.bias.detach().double() \
+            if first.bias is not None else w1.new_zeros(w2.size(0))
+        if second.bias is not None:
+            bias = bias + second.bias.detach().double()
+
+        self.fused = nn.Conv1d(
+            w1.size(1), w2.size(0), kernel_size=k1 + k2 - 1,
+            padding=first.padding[0] + second.padding[0])
+        self.fused.to(device=first.weight.device, dtype=first.weight.dtype)
+        with torch.no_grad():
+            self.fused.weight.copy_(weight)
+            self.fused.bias.copy_(bias)
+        self._edge = second.padding[0]
+        self._strip = 2 * (k1 + k2)
+
+    def forward(self, input):
+        length = input.size(-1)
+        if length <= 2 * self._strip:
+            return self.second(self.first(input))
+        output = self.fused(input)
+        if self._edge > 0:
+            left = self.second(self.first(input[..., :self._strip]))
+            right = self.second(self.first(input[..., -self._strip:]))
+            output = torch.cat([
+                left[..., :self._edge],
+                output[..., self._edge:-self._edge],
+                right[..., -self._edge:]], dim=-1)
+        return output
+
+
+def reverse_complement(x):
+    """Reverse complement of a (N, 4, L) one-hot batch in ACGT order."""
+    return torch.flip(x, [1, 2])
+
+
+def strand_mean(forward, x):
+    """
+    Mean of `forward` over each sequence in `x` and its reverse complement,
+    computed with a single call on the concatenated batch.
+    """
+    # Each sequence is placed next to its own reverse complement, which keeps
+    # the row-by-row pairing of the first and second halves of the batch
+    # that methods such as DeepLIFT rely on (inputs vs. references).
+    batch = torch.stack([x, reverse_complement(x)], dim=1)
+    out = forward(batch.view(-1, x.size(1), x.size(2)))
+    return out.view(-1, 2, out.size(-1)).mean(dim=1)
+
+
+# bp per output column of `Wreath.trunk` (its total pooling stride)
+TRUNK_POOL_STRIDE = 16
+
+# blocks of `Wreath.trunk`, in order, that `checkpoint_blocks` can select
+TRUNK_BLOCKS = ('lconv1', 'conv1', 'lconv2', 'conv2', 'lconv3', 'conv3',
+                'dconv1', 'dconv2', 'dconv3', 'dconv4', 'dconv5')
 
 
 class Wreath(nn.Module):
-    def __init__(self, sequence_length=4096, n_genomic_features=21907):
+    def __init__(self, sequence_length=4096, n_genomic_features=21907,
+                 strand_average=False, checkpoint_blocks=None):
         """
         Parameters
         ----------
         sequence_length : int
         n_genomic_features : int
+        strand_average : bool
+            If `True`, predictions are the mean over each sequence and its
+            reverse complement, computed in a single forward pass over the
+            concatenated batch. Equivalent to wrapping the model in selene's
+            `NonStrandSpecific(mode='mean')`, which runs two passes.
+        checkpoint_blocks : list(str), str or None
+            Trunk blocks (names in `TRUNK_BLOCKS`, or 'all') whose
+            activations are not kept for the backward pass during training
+            but recomputed from the block input, trading compute for memory.
+            Outputs and gradients are unchanged (dropout masks are replayed).
         """
         super(Wreath, self).__init__()
+        self._sequence_length = sequence_length
+        self._n_genomic_features = n_genomic_features
+        self._strand_average = strand_average
+        if checkpoint_blocks == 'all':
+            checkpoint_blocks = TRUNK_BLOCKS
+        unknown = set(checkpoint_blocks or ()) - set(TRUNK_BLOCKS)
+        if unknown:
+            raise ValueError(
+                "Unknown checkpoint_blocks {0}, expected names in {1}".format(
+                    sorted(unknown), TRUNK_BLOCKS))
+        self._checkpoint_blocks = frozenset(checkpoint_blocks or ())
 
         self.lconv1 = nn.Sequential(
             nn.Conv1d(4, 480, kernel_size=9, padding=4),
@@ -166,7 +469,9 @@ class Wreath(nn.Module):
         self._spline_df = int(128/8)
         self.spline_tr = nn.Sequential(
             nn.Dropout(p=0.5),
-            BSplineTransformation(self._spline_df, scaled=False))
+            BSplineTransformation(
+                self._spline_df, scaled=False,
+                spatial_dims=(sequence_length // TRUNK_POOL_STRIDE,)))
 
         self.classifier = nn.Sequential(
             nn.Linear(960 * self._spline_df, n_genomic_features),
@@ -174,35 +479,660 @@ class Wreath(nn.Module):
             nn.Linear(n_genomic_features, n_genomic_features),
             nn.Sigmoid())
 
+        # set by `fuse_for_inference(..., fold_spline=True)`
+        self.fused_head = None
 
-    def forward(self, x):
-        """Forward propagation of a batch.
+
+    def _block(self, name, x):
+        """Apply trunk block `name`, checkpointed if selected."""
+        module = getattr(self, name)
+        if (name in self._checkpoint_blocks and self.training and
+                torch.is_grad_enabled()):
+            return torch.utils.checkpoint.checkpoint(
+                module, x, use_reentrant=False)
+        return module(x)
+
+    def trunk(self, x):
+        """Fully convolutional part of the network, `lconv1` to `dconv5`.
+        Maps a (N, 4, L) batch to (N, 960, L // 16) activations.
         """
-        lout1 = self.lconv1(x)
-        out1 = self.conv1(lout1)
+        lout1 = self._block('lconv1', x)
+        out1 = self._block('conv1', lout1)
 
-        lout2 = self.lconv2(out1 + lout1)
-        out2 = self.conv2(lout2)
+        lout2 = self._block('lconv2', out1 + lout1)
+        out2 = self._block('conv2', lout2)
 
-        lout3 = self.lconv3(out2 + lout2)
-        out3 = self.conv3(lout3)
+        lout3 = self._block('lconv3', out2 + lout2)
+        out3 = self._block('conv3', lout3)
 
-        dconv_out1 = self.dconv1(out3 + lout3)
+        dconv_out1 = self._block('dconv1', out3 + lout3)
         cat_out1 = out3 + dconv_out1
-        dconv_out2 = self.dconv2(cat_out1)
+        dconv_out2 = self._block('dconv2', cat_out1)
         cat_out2 = cat_out1 + dconv_out2
-        dconv_out3 = self.dconv3(cat_out2)
+        dconv_out3 = self._block('dconv3', cat_out2)
         cat_out3 = cat_out2 + dconv_out3
-        dconv_out4 = self.dconv4(cat_out3)
+        dconv_out4 = self._block('dconv4', cat_out3)
         cat_out4 = cat_out3 + dconv_out4
-        dconv_out5 = self.dconv5(cat_out4)
+        dconv_out5 = self._block('dconv5', cat_out4)
         out = cat_out4 + dconv_out5
+        return out
 
+    def head(self, out):
+        """Spline transformation and classifier applied to `trunk` outputs.
+        """
+        if self.fused_head is not None:
+            return self.fused_head(out)
         spline_out = self.spline_tr(out)
         reshape_out = spline_out.view(spline_out.size(0), 960 * self._spline_df)
         output = self.classifier(reshape_out)
         return output
 
+    def forward(self, x):
+        """Forward propagation of a batch.
+        """
+        if self._strand_average:
+            return strand_mean(lambda b: self.head(self.trunk(b)), x)
+        return self.head(self.trunk(x))
+
+    @torch.no_grad()
+    def scan_region(self, region, window_starts, batch_size=128,
+                    chunk_size=65536):
+        """
+        Predict every `sequence_length` bp window of a long region, sharing
+        the convolutional trunk between overlapping windows. Predictions
+        are the same (up to floating point summation order) as those of
+        `forward` on each window cut out of the region.
+
+        Parameters
+        ----------
+        region : torch.Tensor
+            One-hot encoded region of shape (4, R).
+        window_starts : list(int) or numpy.ndarray
+            0-based start offsets of the windows in `region`. Every window
+            must lie entirely inside the region.
+        batch_size : int
+            Maximum number of windows that share a trunk pass.
+        chunk_size : int
+            Maximum distance, in bp, between the first and last window
+            start of a trunk pass.
+
+        Returns
+        -------
+        torch.Tensor
+            Predictions of shape (len(window_starts), n_genomic_features),
+            in the order of `window_starts`.
+
+        Notes
+        -----
+        Windows are grouped by their start offset modulo 16, so that they
+        share a pooling grid, and every trunk layer is run once over the
+        span of each group. Per-window inference zero-pads each convolution
+        at the window boundaries, so the columns of a layer whose receptive
+        field within the trunk reaches a boundary are then recomputed for
+        each window from its own values of the layers below, as in
+        `VariantEngine`. In a 2048 bp window these are the outermost 16, 20
+        and 21 columns on each side at the three resolutions of the trunk,
+        growing to the whole window within the dilated stack. With
+        `strand_average`, the reverse complement of the region is scanned
+        as well and the two strands' predictions are averaged.
+        """
+        starts = torch.as_tensor(window_starts, dtype=torch.long)
+        if len(starts) and (starts.min() < 0 or starts.max() +
+                            self._sequence_length > region.size(-1)):
+            raise ValueError(
+                "All windows must lie within the region of length {0}.".format(
+                    region.size(-1)))
+        output = self._scan(region, starts, batch_size, chunk_size)
+        if self._strand_average:
+            rc_starts = region.size(-1) - self._sequence_length - starts
+            output = (output + self._scan(
+                reverse_complement(region[None])[0], rc_starts,
+                batch_size, chunk_size)) / 2
+        return output
+
+    def _scan(self, region, starts, batch_size, chunk_size):
+        program = _trunk_program(self)
+        # bp per column of each trunk node, and the number of columns on
+        # each side of a window that depend on its zero padding
+        stride, edge, last_use = {'input': 1}, {'input': 0}, {}
+        for ix, (name, op, inputs) in enumerate(program):
+            for source in inputs:
+                last_use[source] = ix
+            stride[name] = stride[inputs[0]]
+            if op == 'add':
+                edge[name] = max(edge[source] for source in inputs)
+            elif isinstance(op, nn.Conv1d):
+                edge[name] = edge[inputs[0]] + \
+                    op.dilation[0] * (op.kernel_size[0] - 1) // 2
+            elif isinstance(op, nn.MaxPool1d):
+                stride[name] *= op.stride
+                edge[name] = -(-edge[inputs[0]] // op.kernel_size)
+            elif isinstance(op, nn.ReLU):
+                edge[name] = edge[inputs[0]]
+            else:
+                raise ValueError(
+                    "Unsupported trunk layer {0}".format(op))
+        layout = (program, stride, edge, last_use)
+
+        output = region.new_empty((len(starts), self._n_genomic_features))
+        for phase in torch.unique(starts % TRUNK_POOL_STRIDE).tolist():
+            ixs = torch.nonzero(
+                starts % TRUNK_POOL_STRIDE == phase).squeeze(1)
+            ixs = ixs[torch.argsort(starts[ixs])]
+            group = starts[ixs].tolist()
+            s = 0
+            while s < len(ixs):
+                e = s + 1
+                while (e < len(ixs) and e - s < batch_size and
+                       group[e] - group[s] <= chunk_size):
+                    e += 1
+                output[ixs[s:e]] = self._scan_group(
+                    region, starts[ixs[s:e]], layout)
+                s = e
+        return output
+
+    def _scan_group(self, region, starts, layout):
+        # predictions for windows at ascending `starts` that share a
+        # pooling grid
+        program, stride, edge, last_use = layout
+        seq_len = self._sequence_length
+        span_start = int(starts[0])
+        offsets = (starts - span_start).to(region.device)
+        shared = {'input': region[None, :, span_start:
+                                  int(starts[-1]) + seq_len]}
+        strips = {'input': None}
+
+        def window(name, u, v):
+            # columns [u, v) of `name` in each window, zero outside of it
+            length = seq_len // stride[name]
+            lo, hi = max(u, 0), min(v, length)
+            cols = (offsets // stride[name])[:, None] + torch.arange(
+                lo, hi, device=offsets.device)
+            values = shared[name][0][:, cols].transpose(0, 1).contiguous()
+            if strips[name] is not None:
+                left, right = strips[name]
+                width = left.size(-1)
+                if min(width, hi) > lo:
+                    values[..., :min(width, hi) - lo] = \
+                        left[..., lo:min(width, hi)]
+                s = max(length - width, lo)
+                if hi > s:
+                    values[..., s - lo:] = \
+                        right[..., s - length + width:hi - length + width]
+            return F.pad(values, (lo - u, v - hi))
+
+        for ix, (name, op, inputs) in enumerate(program):
+            length = seq_len // stride[name]
+            width = min(edge[name], (length + 1) // 2)
+            bounds = ((0, width), (length - width, length))
+            source = inputs[0]
+            if op == 'add':
+                shared[name] = shared[source] + shared[inputs[1]]
+                strips[name] = [window(source, u, v) +
+                                window(inputs[1], u, v) for u, v in bounds]
+            elif isinstance(op, nn.Conv1d):
+                shared[name] = op(shared[source])
+                r = op.dilation[0] * (op.kernel_size[0] - 1) // 2
+                strips[name] = [
+                    F.conv1d(window(source, u - r, v + r), op.weight,
+                             op.bias, dilation=op.dilation)
+                    for u, v in bounds]
+            elif isinstance(op, nn.MaxPool1d):
+                shared[name] = op(shared[source])
+                k = op.kernel_size
+                strips[name] = [F.max_pool1d(window(source, u * k, v * k),
+                                             k, op.stride)
+                                for u, v in bounds]
+            else:
+                shared[name] = F.relu(shared[source])
+                strips[name] = None if strips[source] is None else [
+                    F.relu(strip) for strip in strips[source]]
+            if width == 0:
+                strips[name] = None
+            for source in inputs:
+                if last_use[source] == ix:
+                    del shared[source], strips[source]
+        return self.head(window('out', 0, seq_len // stride['out']))
+
+def fuse_for_inference(model, fold_spline=False, verify=True, n_verify=2,
+                       atol=1e-4):
+    """
+    Return an inference-only copy of `model` in which every pair of
+    directly stacked `Conv1d` layers (those in `lconv1`, `lconv2` and
+    `lconv3`) is folded into a `FusedConvPair` and all `Dropout` modules
+    are removed. `model` may be a `Wreath` or a module wrapping one, e.g.
+    selene's `NonStrandSpecific`; the input model is left unchanged.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+    fold_spline : bool
+        If `True`, also replace the spline transformation and first
+        classifier layer with a `FusedSplineHead`, which folds them into
+        one matrix product at input lengths where that saves multiply-adds.
+    verify : bool
+        If `True`, compare the outputs of the original and fused models on
+        `n_verify` random one-hot sequences and raise a `RuntimeError` if
+        they differ by more than `atol`.
+    n_verify : int
+    atol : float
+
+    Returns
+    -------
+    torch.nn.Module
+        The fused model, in eval mode.
+    """
+    wreaths = [m for m in model.modules() if isinstance(m, Wreath)]
+    if not wreaths:
+        raise ValueError("No Wreath module found in {0}".format(
+            type(model).__name__))
+    fused = copy.deepcopy(model).eval()
+    for module in list(fused.modules()):
+        if not isinstance(module, nn.Sequential):
+            continue
+        layers = [m for m in module if not isinstance(m, nn.Dropout)]
+        merged = []
+        for layer in layers:
+            if (isinstance(layer, nn.Conv1d) and merged and
+                    isinstance(merged[-1], nn.Conv1d)):
+                merged[-1] = FusedConvPair(merged[-1], layer)
+            else:
+                merged.append(layer)
+        for name in list(module._modules.keys()):
+            del module._modules[name]
+        for ix, layer in enumerate(merged):
+            module.add_module(str(ix), layer)
+    if fold_spline:
+        for module in list(fused.modules()):
+            if isinstance(module, Wreath):
+                module.fused_head = FusedSplineHead(
+                    module.spline_tr, module.classifier)
+
+    if verify:
+        was_training = model.training
+        model.eval()
+        param = next(model.parameters())
+        idx = torch.randint(
+            4, (n_verify, wreaths[0]._sequence_length), device=param.device)
+        x = F.one_hot(idx, 4).transpose(1, 2).to(param.dtype)
+        with torch.no_grad():
+            expected = model(x)
+            observed = fused(x)
+        model.train(was_training)
+        max_diff = (expected - observed).abs().max().item()
+        if max_diff > atol:
+            raise RuntimeError(
+                "Fused model deviates from the original model by {0} "
+                "(atol={1}).".format(max_diff, atol))
+    return fused
+
+
+def _trunk_program(model):
+    """
+    `Wreath.trunk` as a list of `(name, op, inputs)` steps, where `op` is a
+    `Conv1d`, `ReLU` or `MaxPool1d` applied to the single input or 'add'
+    summing two inputs. Dropouts are left out and `FusedConvPair`s are
+    split back into their two convolutions. The trunk output is 'out'.
+    """
+    program = []
+
+    def sequential(name, module, source):
+        layers = []
+        for layer in module:
+            if isinstance(layer, FusedConvPair):
+                layers.extend([layer.first, layer.second])
+            elif not isinstance(layer, nn.Dropout):
+                layers.append(layer)
+        for ix, layer in enumerate(layers):
+            target = '{0}.{1}'.format(name, ix)
+            program.append((target, layer, (source,)))
+            source = target
+        return source
+
+    lout1 = sequential('lconv1', model.lconv1, 'input')
+    out1 = sequential('conv1', model.conv1, lout1)
+    program.append(('sum1', 'add', (out1, lout1)))
+    lout2 = sequential('lconv2', model.lconv2, 'sum1')
+    out2 = sequential('conv2', model.conv2, lout2)
+    program.append(('sum2', 'add', (out2, lout2)))
+    lout3 = sequential('lconv3', model.lconv3, 'sum2')
+    out3 = sequential('conv3', model.conv3, lout3)
+    program.append(('sum3', 'add', (out3, lout3)))
+    source, residual = 'sum3', out3
+    for ix in range(1, 6):
+        dconv_out = sequential(
+            'dconv{0}'.format(ix), getattr(model, 'dconv{0}'.format(ix)),
+            source)
+        target = 'out' if ix == 5 else 'cat_out{0}'.format(ix)
+        program.append((target, 'add', (residual, dconv_out)))
+        source, residual = target, target
+    return program
+
+
+class VariantEngine(object):
+    """
+    Predicts the effects of many substitutions in one `Wreath` input window
+    without a full forward pass per variant. The activations of every trunk
+    layer are computed once for the reference window; for each alternative
+    allele, only the columns of each layer within the receptive field of the
+    substituted bases are recomputed, from the cached reference activations
+    around them, before the spline head is applied to the patched trunk
+    output. Predictions are identical (up to floating point summation
+    order) to full forward passes over the mutated windows, including the
+    zero padding at the window boundaries.
+
+    For a single base substitution in a 2048 bp window, the recomputed
+    regions are 33 of 2048 columns at full resolution and 42 and 44 of 512
+    and 128 columns after the two pooling layers, about 6x fewer
+    multiply-adds than a full forward pass.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        A `Wreath` (optionally passed through `fuse_for_inference` or wrapped,
+        e.g. by selene's `NonStrandSpecific`), in eval mode.
+    strand_average : bool or None
+        Average predictions over both strands. Defaults to the `Wreath`'s
+        `strand_average` setting, or `True` if it is wrapped.
+    batch_size : int
+        Number of variants propagated at once by `predict`.
+
+    Examples
+    --------
+    >>> engine = VariantEngine(model)
+    >>> ref_pred = engine.set_reference(ref)  # (4, L) one-hot
+    >>> alt_preds = engine.predict(positions, alts)  # alts: (N, 4) one-hot
+    """
+
+    # zero columns kept on both sides of the cached activations, at least
+    # the largest convolution padding in the trunk
+    _PAD = 64
+
+    def __init__(self, model, strand_average=None, batch_size=64):
+        wreaths = [m for m in model.modules() if isinstance(m, Wreath)]
+        if not wreaths:
+            raise ValueError("No Wreath module found in {0}".format(
+                type(model).__name__))
+        self.model = wreaths[0]
+        if strand_average is None:
+            strand_average = self.model._strand_average or \
+                model is not self.model
+        self._strand_average = strand_average
+        self._batch_size = batch_size
+        self._program = _trunk_program(self.model)
+        self._ref = None
+        self._lengths = None
+
+    @torch.no_grad()
+    def set_reference(self, sequence):
+        """
+        Run and cache the reference window.
+
+        Parameters
+        ----------
+        sequence : torch.Tensor
+            One-hot encoded window of shape (4, L).
+
+        Returns
+        -------
+        torch.Tensor
+            Reference prediction of shape (n_genomic_features,).
+        """
+        param = next(self.model.parameters())
+        x = sequence.to(device=param.device, dtype=param.dtype)[None]
+        if self._strand_average:
+            x = torch.cat([x, reverse_complement(x)])
+        values = {'input': x}
+        for name, op, inputs in self._program:
+            if op == 'add':
+                values[name] = values[inputs[0]] + values[inputs[1]]
+            else:
+                values[name] = op(values[inputs[0]])
+        self._lengths = {k: v.size(-1) for k, v in values.items()}
+        self._ref = {k: F.pad(v, (self._PAD, self._PAD))
+                     for k, v in values.items()}
+        return self._head(values['out'])[0]
+
+    @torch.no_grad()
+    def predict(self, positions, alts):
+        """
+        Predict the reference window with substitutions.
+
+        Parameters
+        ----------
+        positions : list(int) or torch.Tensor
+            0-based position in the window of the (first) substituted base
+            of each variant.
+        alts : torch.Tensor
+            One-hot encoded alternative bases of shape (N, 4) for single
+            base substitutions, or (N, 4, W) for W consecutive bases
+            starting at each position.
+
+        Returns
+        -------
+        torch.Tensor
+            Predictions of shape (N, n_genomic_features).
+        """
+        if self._ref is None:
+            raise ValueError("Call `set_reference` before `predict`.")
+        param = next(self.model.parameters())
+        positions = torch.as_tensor(positions, dtype=torch.long,
+                                    device=param.device)
+        alts = alts.to(device=param.device, dtype=param.dtype)
+        if alts.dim() == 2:
+            alts = alts[..., None]
+        length = self._lengths['input']
+        if len(positions) and (positions.min() < 0 or
+                               positions.max() + alts.size(-1) > length):
+            raise ValueError(
+                "All substitutions must lie within the window of "
+                "length {0}.".format(length))
+
+        output = []
+        for s in range(0, len(positions), self._batch_size):
+            starts = positions[s:s + self._batch_size]
+            patch = alts[s:s + self._batch_size]
+            rows = torch.zeros_like(starts)
+            if self._strand_average:
+                rc_starts = length - alts.size(-1) - starts
+                starts = torch.stack([starts, rc_starts], dim=1).view(-1)
+                patch = torch.stack(
+                    [patch, torch.flip(patch, [1, 2])], dim=1).view(
+                        -1, patch.size(1), patch.size(2))
+                rows = torch.arange(2, device=starts.device).repeat(
+                    len(rows))
+            output.append(self._propagate(rows, starts, patch))
+        if not output:
+            return param.new_empty((0, self.model._n_genomic_features))
+        return torch.cat(output)
+
+    def _head(self, out):
+        output = self.model.head(out)
+        if self._strand_average:
+            output = output.view(-1, 2, output.size(-1)).mean(dim=1)
+        return output
+
+    def _window(self, rows, name, patches, starts, width):
+        # alternative allele values of `name` over columns
+        # [starts, starts + width), which must contain the node's patch
+        ref = self._ref[name]
+        cols = starts[:, None] + self._PAD + torch.arange(
+            width, device=starts.device)
+        window = ref[rows[:, None], :, cols].transpose(1, 2).contiguous()
+        patch_starts, patch = patches[name]
+        cols = (patch_starts - starts)[:, None] + torch.arange(
+            patch.size(-1), device=starts.device)
+        window.scatter_(
+            2, cols[:, None, :].expand(-1, patch.size(1), -1), patch)
+        return window
+
+    def _propagate(self, rows, starts, patch):
+        patches = {'input': (starts, patch)}
+        for name, op, inputs in self._program:
+            length = self._lengths[name]
+            if op == 'add':
+                widths = [patches[k][1].size(-1) for k in inputs]
+                starts, _ = patches[inputs[widths.index(max(widths))]]
+                width = max(widths)
+                patches[name] = (starts, self._window(
+                    rows, inputs[0], patches, starts, width) + self._window(
+                        rows, inputs[1], patches, starts, width))
+                continue
+            in_starts, in_patch = patches[inputs[0]]
+            in_width = in_patch.size(-1)
+            if isinstance(op, nn.Conv1d):
+                radius = op.dilation[0] * (op.kernel_size[0] - 1) // 2
+                width = min(in_width + 2 * radius, length)
+                starts = torch.clamp(in_starts - radius, 0, length - width)
+                window = self._window(rows, inputs[0], patches,
+                                      starts - radius, width + 2 * radius)
+                out = F.conv1d(window, op.weight, op.bias,
+                               dilation=op.dilation)
+            elif isinstance(op, nn.MaxPool1d):
+                k = op.kernel_size
+                width = min((in_width + k - 1) // k + 1, length)
+                starts = torch.clamp(in_starts // k, 0, length - width)
+                window = self._window(rows, inputs[0], patches,
+                                      starts * k, width * k)
+                out = F.max_pool1d(window, k, op.stride)
+            elif isinstance(op, nn.ReLU):
+                starts, out = in_starts, F.relu(in_patch)
+            else:
+                raise ValueError(
+                    "Unsupported trunk layer {0}".format(op))
+            patches[name] = (starts, out)
+        out = self._window(
+            rows, 'out', patches, torch.zeros_like(rows),
+            self._lengths['out'])
+        return self._head(out)
+
+
+def export_onnx(model, path, sequence_length=None, metadata=None,
+                opset_version=17):
+    """
+    Export `model` (a `Wreath`, optionally wrapped, e.g. by selene's
+    `NonStrandSpecific` or after `fuse_for_inference`) to an ONNX file with
+    a dynamic batch dimension. The spline head and strand averaging (if
+    enabled) are part of the exported graph. Requires the `onnx` package.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+    path : str
+        Output .onnx file path.
+    sequence_length : int or None
+        Input sequence length, default is that of the `Wreath` in `model`.
+    metadata : dict or None
+        Optional key-value pairs stored as ONNX model metadata, readable
+        with onnxruntime's `InferenceSession.get_modelmeta()`.
+    opset_version : int
+
+    Returns
+    -------
+    str
+        `path`
+    """
+    import onnx
+
+    if sequence_length is None:
+        sequence_length = next(
+            m for m in model.modules()
+            if isinstance(m, Wreath))._sequence_length
+    param = next(model.parameters())
+    example = torch.full((2, 4, sequence_length), 0.25,
+                         device=param.device, dtype=param.dtype)
+    export_kwargs = {}
+    # torch >= 2.5 can export with dynamo; keep the TorchScript exporter
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs['dynamo'] = False
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            model, (example,), path, input_names=['sequence'],
+            output_names=['predictions'],
+            dynamic_axes={'sequence': {0: 'batch'},
+                          'predictions': {0: 'batch'}},
+            opset_version=opset_version, **export_kwargs)
+    model.train(was_training)
+
+    if metadata:
+        onnx_model = onnx.load(path)
+        for key, value in metadata.items():
+            prop = onnx_model.metadata_props.add()
+            prop.key = key
+            prop.value = str(value)
+        onnx.save(onnx_model, path)
+    return path
+
+
+class QuantizedWreath(nn.Module):
+    """
+    CPU inference wrapper around a quantized `Wreath` graph, returned by
+    `quantize_for_cpu`. Strand averaging is applied outside the quantized
+    graph.
+    """
+
+    def __init__(self, model, strand_average=False):
+        super(QuantizedWreath, self).__init__()
+        self.model = model
+        self._strand_average = strand_average
+
+    def forward(self, x):
+        if self._strand_average:
+            return strand_mean(self.model, x)
+        return self.model(x)
+
+
+def quantize_for_cpu(model, calibration_batches, backend='x86'):
+    """
+    Post-training int8 quantization of a `Wreath` for CPU inference, using
+    FX graph mode quantization. The `Conv1d` stack (with its pooling and
+    residual additions) is statically quantized, with activation ranges
+    calibrated on `calibration_batches`; the classifier `Linear` layers are
+    dynamically quantized; the spline transformation stays in float.
+    `model` must not have been through `fuse_for_inference`.
+
+    Parameters
+    ----------
+    model : Wreath
+    calibration_batches : iterable(torch.Tensor)
+        CPU batches of shape (N, 4, sequence_length) representative of the
+        data the quantized model will be run on.
+    backend : str
+        Quantized engine, 'x86' or 'fbgemm' on x86 CPUs, 'qnnpack' on ARM.
+
+    Returns
+    -------
+    QuantizedWreath
+    """
+    from torch.ao.quantization import default_dynamic_qconfig
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx
+    from torch.ao.quantization.quantize_fx import prepare_fx
+
+    torch.backends.quantized.engine = backend
+    float_model = copy.deepcopy(model).cpu().float().eval()
+    strand_average = float_model._strand_average
+    float_model._strand_average = False
+
+    qconfig_mapping = get_default_qconfig_mapping(backend) \
+        .set_module_name('spline_tr', None) \
+        .set_module_name('classifier', default_dynamic_qconfig)
+    prepare_custom_config = {
+        'non_traceable_module_class': [BSplineTransformation]}
+
+    batches = iter(calibration_batches)
+    first = next(batches)
+    prepared = prepare_fx(
+        float_model, qconfig_mapping, example_inputs=(first,),
+        prepare_custom_config=prepare_custom_config)
+    with torch.no_grad():
+        prepared(first)
+        for batch in batches:
+            prepared(batch)
+    return QuantizedWreath(convert_fx(prepared), strand_average).eval()
+
 
 def criterion():
     """
@@ -24,6 +24,11 @@ if __name__ == "__main__":
         "--genome",
         required=True,
         help="Specify 'hg19' or 'hg38'.")
+    parser.add_argument(
+        "--dedup-refs",
+        action="store_true",
+        help="Write each unique reference sequence once, with a table "
+             "mapping variants to their reference and alternative records.")
     args = parser.parse_args()
     print(args.input, args.output)
     loci_df = pd.read_csv(args.input, sep='\t', header=None)
@@ -44,22 +49,43 @@ if __name__ == "__main__":
         vset.add(variant)
 
     genome = Genome('../../resources/{0}_UCSC.fa'.format(args.genome))
-    refs, alts, labels = process_variants(loci_to_variants.items(), 2048, genome)
+    refs, alts, labels = process_variants(
+        loci_to_variants.items(), 2048, genome, dedup_refs=args.dedup_refs)
     print(Counter(labels['sub_info']))
 
-    labels['ref'] = refs
     labels['alt'] = alts
-    with open('{0}.refs.pm1kb.seqlen=2048.fasta'.format(args.output),
-              'w+') as fh:
-        for row in labels.itertuples():
-            fh.write(">{0}_{1}_ref\n".format(row.loci, row.variant))
-            assert len(row.ref) == 2048
-            fh.write('{0}\n'.format(row.ref))
+    if args.dedup_refs:
+        print("{0} unique reference sequences for {1} variants".format(
+            len(refs), len(labels)))
+        first = labels.drop_duplicates('ref_index').set_index('ref_index')
+        ref_names = [
+            '{0}_window'.format(row.loci) if row.sub_info in (
+                'match', 'complement') else
+            '{0}_{1}'.format(row.loci, row.variant)
+            for row in first.loc[np.arange(len(refs))].itertuples()]
+        with open('{0}.refs.pm1kb.seqlen=2048.fasta'.format(args.output),
+                  'w+') as fh:
+            for name, ref in zip(ref_names, refs):
+                fh.write(">{0}_ref\n".format(name))
+                assert len(ref) == 2048
+                fh.write('{0}\n'.format(ref))
+        # row `i` of this table is row `i` of the alt predictions; its
+        # reference predictions are in row `ref_index` of the ref predictions
+        labels[['loci', 'variant', 'sub_info', 'contains_unk',
+                'ref_index']].to_csv(
+            '{0}.variants.pm1kb.seqlen=2048.tsv'.format(args.output),
+            sep='\t', index_label='index')
+    else:
+        labels['ref'] = refs
+        with open('{0}.refs.pm1kb.seqlen=2048.fasta'.format(args.output),
+                  'w+') as fh:
+            for row in labels.itertuples():
+                fh.write(">{0}_{1}_ref\n".format(row.loci, row.variant))
+                assert len(row.ref) == 2048
+                fh.write('{0}\n'.format(row.ref))
     with open('{0}.alts.pm1kb.seqlen=2048.fasta'.format(args.output),
               'w+') as fh:
         for row in labels.itertuples():
             fh.write(">{0}_{1}_alt\n".format(row.loci, row.variant))
             assert len(row.alt) == 2048
             fh.write('{0}\n'.format(row.alt))
-
-
@@ -1,65 +1,114 @@
 from collections import OrderedDict
+import os
+import sys
 
 import numpy as np
 import pandas as pd
 from selene_sdk.sequences import Genome
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'train'))
+from packbits import unpackbits_sequence
 
-def process_variants(loci_to_variants, seq_len, genome, compress=False):
+
+def process_variants(loci_to_variants, seq_len, genome, compress=False,
+                     dedup_refs=False, window_block=10000):
     """
     Assumes `seq_len` is an even number
+
+    If `compress`, sequences are output as packbits arrays of shape
+    (seq_len / 8, 4), the layout of the training and evaluation datasets,
+    and 'nomatch' variants get the unmodified window as both sequences.
+    `genome` may then also be a `PackedGenome` (`../packed_genome.py`), from
+    which the windows of `window_block` loci are extracted at a time.
+
+    If `dedup_refs`, each unique reference sequence is output once and the
+    `ref_index` label column gives the row of each variant's reference in
+    the output references. The reference of 'match' and 'complement'
+    variants is the unmodified window around the locus, shared by all of
+    them, so it is keyed by (chrom, pos, orientation) instead of by variant.
     """
     output_refs = []
     output_alts = []
     output_labels = []
+    ref_indices = {}
 
     variants_total = 0
     mismatch_total = 0
-    for (chrom, pos), variants in loci_to_variants:
-        query = genome.get_sequence_from_coords(
-            chrom, pos - seq_len // 2, pos + seq_len // 2)
-        contains_unk = False
-        if len(query) != seq_len:
-            print("Skipping: ({0} {1}), seq len = {2}".format(
-                chrom, pos, len(query)))
-            continue
-        ref = str.upper(query[(seq_len // 2) - 1])
+    # a `PackedGenome` (`../packed_genome.py`) extracts the packed windows
+    # of many loci in one call
+    batched = compress and hasattr(genome, 'get_windows')
+    loci_to_variants = list(loci_to_variants)
+    for lix, ((chrom, pos), variants) in enumerate(loci_to_variants):
+        if batched:
+            if lix % window_block == 0:
+                block = loci_to_variants[lix:lix + window_block]
+                windows, valid = genome.get_windows(
+                    [c for (c, _), _ in block], [p for (_, p), _ in block],
+                    seq_len)
+            window = windows[lix % window_block]
+            if not valid[lix % window_block]:
+                print("Skipping: ({0} {1}), outside of the genome".format(
+                    chrom, pos))
+                continue
+            bits = np.unpackbits(window, axis=0)
+            center = bits[(seq_len // 2) - 1]
+            ref = 'ACGT'[center.argmax()] if center.sum() == 1 else 'N'
+            contains_unk = bool((bits.sum(axis=1) == 4).any())
+        else:
+            query = genome.get_sequence_from_coords(
+                chrom, pos - seq_len // 2, pos + seq_len // 2)
+            contains_unk = False
+            if len(query) != seq_len:
+                print("Skipping: ({0} {1}), seq len = {2}".format(
+                    chrom, pos, len(query)))
+                continue
+            ref = str.upper(query[(seq_len // 2) - 1])
+            if 'N' in query.upper():
+                contains_unk = True
         if ref.upper() != 'C':
             mismatch_total += 1
             if mismatch_total % 100 == 0:
                 print("Mismatches: {0}, {1}".format(mismatch_total, ref))
             continue
-        if 'N' in query.upper():
-            contains_unk = True
-        for v in set(variants):
-            variants_total += 1
-            info = v.split('_')
-            if len(info) == 5:
-                c, p, vid, r, a = v.split('_')
-            else:
-                c, p, r, a = v.split('_')
-            p = int(p)
-            ref_sequence, alt_sequence, vinfo = substitution(
-                query, pos, c, p, r, a)
-            # this could be done faster by using the encoding directly
-            # and making the encoded substitutions instead of doing it after
-            # the fact
+        variants = list(set(variants))
+        infos = [v.split('_') for v in variants]
+        # (chrom, pos, ref, alt) of each variant; the ID is optional
+        infos = [(i[0], int(i[1]), i[-2], i[-1]) for i in infos]
+        variants_total += len(variants)
+        if compress:
+            # substitute directly into the packed window, see
+            # `substitute_encoded`
+            if not batched:
+                window = np.packbits(
+                    Genome.sequence_to_encoding(query) > 0, axis=0)
+            offsets = np.array([p for (_, p, _, _) in infos]) - \
+                (pos - seq_len // 2) - 1
+            refs_enc, alts_enc, sub_infos = substitute_encoded(
+                window, offsets, [r for (_, _, r, _) in infos],
+                [a for (_, _, _, a) in infos])
+        for ix, v in enumerate(variants):
             if compress:
-                ref_enc = Genome.sequence_to_encoding(ref_sequence)
-                alt_enc = Genome.sequence_to_encoding(alt_sequence)
-                ref_enc = np.packbits(ref_enc.T > 0, axis=1)
-                alt_enc = np.packbits(alt_enc.T > 0, axis=1)
-                output_refs.append(ref_enc.T)
-                output_alts.append(alt_enc.T)
+                ref_sequence, alt_sequence, vinfo = \
+                    refs_enc[ix], alts_enc[ix], str(sub_infos[ix])
             else:
-                output_refs.append(ref_sequence)
-                output_alts.append(alt_sequence)
-            output_labels.append({
+                ref_sequence, alt_sequence, vinfo = substitution(
+                    query, pos, *infos[ix])
+            label = {
                 'loci': '{0}_{1}'.format(chrom, pos),
                 'contains_unk': contains_unk,
                 'variant': v,
                 'sub_info': vinfo
-            })
+            }
+            if dedup_refs:
+                # 'swap' and 'complement_swap' references are unique
+                ref_key = (chrom, pos, 'window') \
+                    if vinfo in ('match', 'complement') else (chrom, pos, v)
+                label['ref_index'] = ref_indices.setdefault(
+                    ref_key, len(ref_indices))
+            if not dedup_refs or label['ref_index'] == len(output_refs):
+                output_refs.append(ref_sequence)
+            output_alts.append(alt_sequence)
+            output_labels.append(label)
     print("Skipped prop. {0}".format(mismatch_total / variants_total))
     return output_refs, output_alts, pd.DataFrame(output_labels)
 
@@ -124,6 +173,111 @@ def substitution(seq, spos, vchr, vpos, vref, valt):
     return ref_sequence, alt_sequence, info
 
 
+# labels of the `substitute_encoded` cases, in order of precedence
+SUB_INFO = np.array(
+    ['nomatch', 'match', 'swap', 'complement', 'complement_swap'])
+
+# ASCII code -> index of the base in ACGT order, -1 for N and the other
+# IUPAC ambiguity codes, -2 for anything else (e.g. '-', '*' or '.')
+_BASE_LUT = np.full(256, -2, dtype=np.int64)
+for _base in 'NRYSWKMBDHV':
+    _BASE_LUT[ord(_base)] = -1
+    _BASE_LUT[ord(_base.lower())] = -1
+for _ix, _base in enumerate('ACGT'):
+    _BASE_LUT[ord(_base)] = _ix
+    _BASE_LUT[ord(_base.lower())] = _ix
+
+
+def base_indices(bases):
+    """
+    ACGT indices of single base alleles: -1 for N and the other IUPAC
+    ambiguity codes, and -2 for alleles that are not a base substitution
+    (indels, MNVs and missing or deleted allele markers such as '-').
+    """
+    bases = list(bases)
+    single = np.array([len(b) == 1 and b.isascii() for b in bases],
+                      dtype=bool)
+    codes = np.frombuffer(''.join(
+        b if ok else '-' for b, ok in zip(bases, single)).encode(),
+        dtype=np.uint8)
+    return _BASE_LUT[codes]
+
+
+def substitute_encoded(window, offsets, vrefs, valts, packed=True):
+    """
+    `substitution` for many variants in one encoded window at once. Each
+    variant is classified as 'match', 'swap', 'complement' or
+    'complement_swap' by comparing the window base at its offset with its
+    ref and alt bases (or 'nomatch', including N window bases and
+    variants that are not single base substitutions), and the ref and alt
+    windows are built with array operations. N or other IUPAC ambiguity
+    codes in the ref or alt allele are written as N.
+
+    Parameters
+    ----------
+    window : numpy.ndarray
+        The window as a packbits array of shape (L / 8, 4) (one-hot bits
+        packed along the sequence, N bases are all ones), or with
+        `packed=False` a one-hot array of shape (L, 4).
+    offsets : numpy.ndarray
+        0-based offset of each variant in the window.
+    vrefs, valts : list(str)
+        Reference and alternative base of each variant.
+    packed : bool
+
+    Returns
+    -------
+    refs, alts : numpy.ndarray
+        Windows of shape (N,) + `window.shape`, in the format of `window`.
+        Both are the unmodified window for 'nomatch' variants.
+    info : numpy.ndarray
+        The case of each variant.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    vref = base_indices(vrefs)
+    valt = base_indices(valts)
+    if packed:
+        byte = offsets // 8
+        shift = (7 - offsets % 8).astype(np.uint8)
+        bits = (window[byte] >> shift[:, None]) & 1
+    else:
+        bits = window[offsets] > 0
+    ans = np.where(bits.sum(axis=-1) == 1, bits.argmax(axis=-1), -1)
+
+    def complement(b):
+        # in ACGT order the complement of base index b is 3 - b
+        return np.where(b >= 0, 3 - b, -1)
+
+    case = np.select(
+        [ans == vref, ans == valt,
+         ans == complement(vref), ans == complement(valt)],
+        [1, 2, 3, 4], 0)
+    case[(ans < 0) | (vref == -2) | (valt == -2)] = 0
+    # the base substituted into the window, which is the ref window for
+    # 'match' and 'complement' and the alt window otherwise
+    sub_base = np.choose(case, [
+        np.zeros_like(ans), valt, vref, complement(valt), complement(vref)])
+    window_is_ref = np.isin(case, (1, 3))
+
+    unchanged = np.repeat(window[None], len(offsets), axis=0)
+    edited = unchanged.copy()
+    rows = np.nonzero(case > 0)[0]
+    # encoding of each base in ACGT order, then of N (index -1), as in
+    # `Genome.sequence_to_encoding` or its packbits (any bit set)
+    encoding = np.vstack([np.eye(4), Genome.sequence_to_encoding('N')])
+    if packed:
+        mask = np.left_shift(1, shift[rows]).astype(window.dtype)[:, None]
+        bits = (encoding[sub_base[rows]] > 0).astype(window.dtype)
+        edited[rows, byte[rows]] = \
+            (edited[rows, byte[rows]] & ~mask) | (bits * mask)
+    else:
+        edited[rows, offsets[rows]] = encoding[sub_base[rows]]
+    window_is_ref = window_is_ref[:, None, None]
+    refs = np.where(window_is_ref, unchanged, edited)
+    alts = np.where(window_is_ref, edited, unchanged)
+    return refs, alts, SUB_INFO[case]
+
+
 def init_weights(model, checkpoint):
      state_dict = checkpoint
      if 'state_dict' in checkpoint:
@@ -142,15 +296,3 @@ def init_weights(model, checkpoint):
                  k1, k2))
      model.load_state_dict(new_state_dict, strict=False)
      return model
-
-
-def unpackbits_sequence(sequence, s_len):
-    sequence = np.unpackbits(sequence.astype(np.uint8), axis=-2)
-    nulls = np.sum(sequence, axis=-1) == sequence.shape[-1]
-    sequence = sequence.astype(float)
-    sequence[nulls, :] = 1.0 / sequence.shape[-1]
-    if sequence.ndim == 3:
-        sequence = sequence[:, :s_len, :]
-    else:
-        sequence = sequence[:s_len, :]
-    return sequence
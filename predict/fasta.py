@@ -1,14 +1,28 @@
 """
 CLI for Wreath prediction given an input FASTA file.
 """
+import copy
 import os
+import sys
 
 from argparse import ArgumentParser
+import h5py
+import numpy as np
+import pyfaidx
+import torch
 import yaml
 
+from selene_sdk.sequences import Genome
 from selene_sdk.utils import load_path
 from selene_sdk.utils import parse_configs_and_run
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'train'))
+from utils import autocast
+from utils import init_weights
+from utils import load_exported_model
+from utils import load_model_arch
+from utils import load_onnx_session
+
 
 def _finditem(obj, val):
     for k, v in obj.items():
@@ -20,6 +34,114 @@ def _finditem(obj, val):
             obj[k] = v.replace('<PATH>', val)
 
 
+def _center_sequence(sequence, seq_len):
+    # same centering as selene: pad both sides with N, or trim both sides
+    if len(sequence) < seq_len:
+        diff = seq_len - len(sequence)
+        return 'N' * (diff // 2) + sequence + 'N' * (diff - diff // 2)
+    start = (len(sequence) - seq_len) // 2
+    return sequence[start:start + seq_len]
+
+
+def _encode_batch(fasta_file, labels, seq_len, device, dtype=torch.float32):
+    # (N, 4, seq_len) one-hot batch of the sequences named `labels`
+    batch = np.stack([
+        Genome.sequence_to_encoding(
+            _center_sequence(str(fasta_file[label]), seq_len))
+        for label in labels])
+    return torch.from_numpy(batch).to(
+        device=device, dtype=dtype).transpose(1, 2)
+
+
+def predict_with_artifact(artifact, fasta, output_dir, batch_size, use_cuda,
+                          intra_op_threads=None):
+    """
+    Predict every sequence in `fasta` with an exported model artifact (see
+    `../eval/export_model.py`), writing the same `<name>_predictions.h5`
+    and `<name>_row_labels.txt` outputs as selene's hdf5 output format.
+    ONNX artifacts run on CPU with onnxruntime, with `intra_op_threads`
+    threads per operator.
+    """
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    if artifact.endswith('.onnx'):
+        device = torch.device('cpu')
+        session, metadata = load_onnx_session(
+            artifact, intra_op_threads=intra_op_threads)
+
+        def model(batch):
+            return torch.from_numpy(session.run(
+                None, {'sequence': np.ascontiguousarray(batch.numpy())})[0])
+    else:
+        model, metadata = load_exported_model(artifact, device=device)
+    seq_len = metadata['seq_len']
+    dtype = getattr(torch, metadata['dtype'])
+
+    name = os.path.splitext(os.path.basename(fasta))[0]
+    fasta_file = pyfaidx.Fasta(fasta)
+    labels = list(fasta_file.keys())
+    preds_out = os.path.join(output_dir, '{0}_predictions.h5'.format(name))
+    with h5py.File(preds_out, 'w') as write_fh:
+        preds = write_fh.create_dataset(
+            'data', (len(labels), metadata['n_targets']), dtype=np.float32)
+        for ix in range(0, len(labels), batch_size):
+            batch = _encode_batch(
+                fasta_file, labels[ix:ix + batch_size], seq_len, device,
+                dtype=dtype)
+            with torch.no_grad():
+                preds[ix:ix + len(batch)] = model(batch).float().cpu().numpy()
+
+    labels_out = os.path.join(output_dir, '{0}_row_labels.txt'.format(name))
+    with open(labels_out, 'w') as write_fh:
+        write_fh.write('index\tname\n')
+        for ix, label in enumerate(labels):
+            write_fh.write('{0}\t{1}\n'.format(ix, label))
+    return preds_out
+
+
+def precision_report(model_configs, weights_path, fasta, seq_len,
+                     batch_size, precision, use_cuda, n_batches=10):
+    """
+    Predict the first `n_batches` batches of `fasta` (all of them if -1)
+    both in float32 and under autocast at `precision`, and return the
+    maximum and mean absolute deviation of the autocast predictions, which
+    selene stores as float32, in the format of the precision report of
+    `../eval/get_model_predictions.py`.
+    """
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    model = load_model_arch(model_configs)
+    checkpoint = torch.load(weights_path,
+                            map_location=lambda storage, location: storage)
+    model = init_weights(model, checkpoint)
+    model.to(device)
+    model.eval()
+
+    fasta_file = pyfaidx.Fasta(fasta)
+    labels = list(fasta_file.keys())
+    if n_batches >= 0:
+        labels = labels[:n_batches * batch_size]
+    n_targets, max_dev, sum_dev = 0, 0., 0.
+    for ix in range(0, len(labels), batch_size):
+        batch = _encode_batch(
+            fasta_file, labels[ix:ix + batch_size], seq_len, device)
+        with torch.no_grad():
+            fp32_preds = model(batch).cpu().numpy()
+            with autocast(precision, device):
+                preds = model(batch).float().cpu().numpy()
+        dev = np.abs(preds - fp32_preds)
+        n_targets = dev.shape[1]
+        max_dev = max(max_dev, float(dev.max()))
+        sum_dev += float(dev.sum())
+    return {
+        'precision': precision,
+        'device': str(device),
+        'storage_dtype': 'float32',
+        'n_sequences_compared': len(labels),
+        'max_abs_deviation_vs_fp32': max_dev,
+        'mean_abs_deviation_vs_fp32':
+            sum_dev / max(1, len(labels) * n_targets),
+    }
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument(
@@ -42,7 +164,40 @@ if __name__ == "__main__":
         action="store_true",
         help="Use CUDA for processing"
     )
+    parser.add_argument(
+        "--precision",
+        choices=["fp32", "fp16"],
+        default="fp32",
+        help="Run the model under fp16 autocast (requires --cuda). bf16 is "
+             "not offered because selene converts predictions with numpy, "
+             "which has no bfloat16 type"
+    )
+    parser.add_argument(
+        "--precision-report-batches",
+        type=int,
+        default=10,
+        help="With --precision=fp16, number of batches (-1 for all) also "
+             "run in fp32 to report the deviation of the predictions, "
+             "default is 10"
+    )
+    parser.add_argument(
+        "--artifact",
+        default=None,
+        help="Predict with a model exported by ../eval/export_model.py "
+             "(TorchScript, or ONNX if the path ends in .onnx) instead of "
+             "selene; its sequence length and precision are used and "
+             "--precision is ignored"
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=None,
+        help="Number of threads per operator for an ONNX --artifact, "
+             "default is onnxruntime's"
+    )
     args = parser.parse_args()
+    if args.precision == "fp16" and not args.cuda and not args.artifact:
+        parser.error("--precision=fp16 requires --cuda")
 
     os.makedirs(args.output_dir, exist_ok=True)
 
@@ -55,6 +210,38 @@ if __name__ == "__main__":
     fp = configs["analyze_sequences"].keywords["trained_model_path"]
     _finditem(configs, use_dir)
 
+    if args.artifact:
+        print(predict_with_artifact(
+            args.artifact, args.fasta, args.output_dir,
+            configs["analyze_sequences"].keywords["batch_size"], use_cuda,
+            intra_op_threads=args.intra_op_threads))
+        raise SystemExit(0)
+
+    # the model selene runs, for the precision report: selene only wraps it
+    # in `NonStrandSpecific` if `non_strand_specific` is set
+    model_configs = copy.deepcopy(configs["model"])
+    model_configs.setdefault("non_strand_specific", "none")
+    # selene only knows the two-pass `NonStrandSpecific` modes, so the
+    # single-pass mode is handed to Wreath as a class argument instead.
+    if configs["model"].get("non_strand_specific") == "batched":
+        configs["model"].pop("non_strand_specific")
+        configs["model"]["class_args"]["strand_average"] = True
+
     configs["prediction"]["input_path"] = args.fasta
     configs["prediction"]["output_dir"] = args.output_dir
-    parse_configs_and_run(configs)
+    with autocast(args.precision, "cuda" if use_cuda else "cpu"):
+        parse_configs_and_run(configs)
+
+    if args.precision != "fp32" and args.precision_report_batches != 0:
+        analyze_args = configs["analyze_sequences"].keywords
+        report = precision_report(
+            model_configs, analyze_args["trained_model_path"], args.fasta,
+            analyze_args["sequence_length"], analyze_args["batch_size"],
+            args.precision, use_cuda,
+            n_batches=args.precision_report_batches)
+        report_out = os.path.join(args.output_dir, '{0}_precision.yaml'.format(
+            os.path.splitext(os.path.basename(args.fasta))[0]))
+        with open(report_out, 'w') as report_fh:
+            yaml.dump(report, report_fh)
+        print(report_out)
+        print(report)
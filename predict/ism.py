@@ -0,0 +1,212 @@
+"""
+CLI and API for in-silico saturation mutagenesis (ISM) of Wreath input
+windows: every single base substitution in a window (or a sub-window
+around its center CpG) is scored against the reference prediction.
+"""
+import os
+
+from argparse import ArgumentParser
+import h5py
+import numpy as np
+import pyfaidx
+import torch
+
+from selene_sdk.sequences import Genome
+from selene_sdk.utils import load_model_from_state_dict
+from selene_sdk.utils import load_path
+from selene_sdk.utils.config_utils import module_from_file
+
+from packed_genome import PackedGenome
+
+
+def load_engine(configs, use_cuda=False):
+    """
+    Build the model described by a `fasta.yaml`-style configuration, load
+    its trained weights and return a `VariantEngine` for it (see
+    `../model/wreath.py`). Both `non_strand_specific` modes average the two
+    strands.
+    """
+    model_configs = configs["model"]
+    module = module_from_file(model_configs["path"])
+    class_args = dict(model_configs["class_args"])
+    class_args.pop("strand_average", None)
+    model = getattr(module, model_configs["class"])(**class_args)
+    trained_model_path = \
+        configs["analyze_sequences"].keywords["trained_model_path"]
+    checkpoint = torch.load(trained_model_path,
+                            map_location=lambda storage, location: storage)
+    if "state_dict" in checkpoint:
+        checkpoint = checkpoint["state_dict"]
+    model = load_model_from_state_dict(checkpoint, model)
+    if use_cuda:
+        model.cuda()
+    model.eval()
+    strand_average = model_configs.get(
+        "non_strand_specific", "mean") in ("mean", "batched")
+    return module.VariantEngine(
+        model, strand_average=strand_average,
+        batch_size=configs["analyze_sequences"].keywords["batch_size"])
+
+
+def saturation_mutagenesis(engine, sequence, start=0, end=None):
+    """
+    Score all single base substitutions in `sequence[:, start:end]`.
+
+    Parameters
+    ----------
+    engine : VariantEngine
+    sequence : numpy.ndarray or torch.Tensor
+        One-hot encoded window of shape (4, L), in ACGT order. N bases
+        (all 0.25) are substituted by each of the four bases.
+    start : int
+    end : int or None
+        Sub-window of positions to mutate, default is the whole window.
+
+    Returns
+    -------
+    ref_pred : torch.Tensor
+        Reference prediction of shape (n_targets,).
+    effects : torch.Tensor
+        Tensor of shape (end - start, 4, n_targets) with the alternative
+        minus the reference prediction for substituting each base at each
+        position; entries for the reference bases are 0.
+    """
+    sequence = torch.as_tensor(sequence, dtype=torch.float32)
+    if end is None:
+        end = sequence.size(-1)
+    ref_pred = engine.set_reference(sequence)
+
+    sub = sequence[:, start:end]
+    positions, bases = torch.nonzero(sub.t() != 1, as_tuple=True)
+    alts = torch.eye(4)[bases]
+    alt_preds = engine.predict(positions + start, alts)
+
+    effects = ref_pred.new_zeros((end - start, 4, ref_pred.size(-1)))
+    effects[positions.to(effects.device), bases.to(effects.device)] = \
+        alt_preds - ref_pred
+    return ref_pred, effects
+
+
+def _windows_from_fasta(fasta_path, seq_len):
+    fasta_file = pyfaidx.Fasta(fasta_path)
+    for name in fasta_file.keys():
+        sequence = str(fasta_file[name])
+        if len(sequence) != seq_len:
+            print("Skipping: {0}, seq len = {1}".format(name, len(sequence)))
+            continue
+        yield name, sequence
+
+
+def _windows_from_loci(loci_path, genome_path, seq_len):
+    genome = PackedGenome(genome_path) if os.path.isdir(genome_path) \
+        else Genome(genome_path)
+    with open(loci_path) as fh:
+        for line in fh:
+            chrom, pos = line.split()[:2]
+            pos = int(pos)
+            sequence = genome.get_sequence_from_coords(
+                chrom, pos - seq_len // 2, pos + seq_len // 2)
+            if len(sequence) != seq_len:
+                print("Skipping: ({0} {1}), seq len = {2}".format(
+                    chrom, pos, len(sequence)))
+                continue
+            yield '{0}_{1}'.format(chrom, pos), sequence
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--yaml",
+        required=True,
+        help="Input YAML configuration file path, e.g. ./fasta.yaml"
+    )
+    parser.add_argument(
+        "--fasta",
+        default=None,
+        help="FASTA file of windows to mutate, centered on the CpG loci"
+    )
+    parser.add_argument(
+        "--loci",
+        default=None,
+        help="Alternatively, a tab-separated file whose first two columns "
+             "are the chromosome and position of each CpG locus; windows "
+             "are read from --genome"
+    )
+    parser.add_argument(
+        "--genome",
+        default=None,
+        help="Reference genome FASTA for --loci, or a genome store "
+             "directory written by packed_genome.py"
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Output .h5 file path"
+    )
+    parser.add_argument(
+        "--radius",
+        type=int,
+        default=None,
+        help="Only mutate positions within this many bp of the window "
+             "center, default is the whole window"
+    )
+    parser.add_argument(
+        "--cuda",
+        action="store_true",
+        help="Use CUDA for processing"
+    )
+    args = parser.parse_args()
+    if (args.fasta is None) == (args.loci is None):
+        parser.error("Specify one of --fasta or --loci")
+    if args.loci and not args.genome:
+        parser.error("--loci requires --genome")
+
+    configs = load_path(args.yaml, instantiate=False)
+    seq_len = configs["model"]["class_args"]["sequence_length"]
+    n_targets = configs["model"]["class_args"]["n_genomic_features"]
+    engine = load_engine(configs, use_cuda=args.cuda)
+
+    start, end = 0, seq_len
+    if args.radius is not None:
+        start = max(0, seq_len // 2 - args.radius)
+        end = min(seq_len, seq_len // 2 + args.radius)
+    if args.fasta:
+        windows = _windows_from_fasta(args.fasta, seq_len)
+    else:
+        windows = _windows_from_loci(args.loci, args.genome, seq_len)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    names = []
+    with h5py.File(args.output, 'w') as write_fh:
+        # chunks hold up to 256 positions of a single window
+        effects = write_fh.create_dataset(
+            'effects', (0, end - start, 4, n_targets),
+            maxshape=(None, end - start, 4, n_targets),
+            chunks=(1, min(256, end - start), 4, n_targets),
+            dtype=np.float32)
+        refs = write_fh.create_dataset(
+            'ref_predictions', (0, n_targets), maxshape=(None, n_targets),
+            chunks=(64, n_targets), dtype=np.float32)
+        effects.attrs['start'] = start
+        effects.attrs['end'] = end
+        for ix, (name, sequence) in enumerate(windows):
+            encoding = Genome.sequence_to_encoding(sequence).T
+            ref_pred, window_effects = saturation_mutagenesis(
+                engine, encoding, start=start, end=end)
+            effects.resize(ix + 1, axis=0)
+            refs.resize(ix + 1, axis=0)
+            effects[ix] = window_effects.cpu().numpy()
+            refs[ix] = ref_pred.cpu().numpy()
+            names.append(name)
+            if (ix + 1) % 100 == 0:
+                print("Scored {0} windows".format(ix + 1))
+
+    labels_out = '{0}_row_labels.txt'.format(args.output.rsplit('.', 1)[0])
+    with open(labels_out, 'w') as write_fh:
+        write_fh.write('index\tname\n')
+        for ix, name in enumerate(names):
+            write_fh.write('{0}\t{1}\n'.format(ix, name))
+    print(args.output)
+    print(labels_out)
@@ -0,0 +1,182 @@
+"""
+Memory-mapped, 2-bit packed reference genome store. `convert_fasta` turns
+a genome FASTA (e.g. `../resources/hg38_UCSC.fa`) into a directory with
+one 2-bit sequence array and one N mask per chromosome; `PackedGenome`
+memory-maps the store, so worker processes share its pages, and extracts
+many windows in one vectorized call. Run this file to convert a FASTA:
+
+    python packed_genome.py --fasta=../resources/hg38_UCSC.fa \
+        --output=../resources/hg38_UCSC.packed
+"""
+import json
+import os
+
+from argparse import ArgumentParser
+import numpy as np
+import pyfaidx
+
+
+BASES = 'ACGT'
+
+# ASCII code -> 2-bit base code, 4 for N and any other character
+_CODE_LUT = np.full(256, 4, dtype=np.uint8)
+for _ix, _base in enumerate(BASES):
+    _CODE_LUT[ord(_base)] = _ix
+    _CODE_LUT[ord(_base.lower())] = _ix
+
+_INDEX_FILE = 'index.json'
+
+
+def _pack_codes(codes):
+    # 2-bit codes (N bases as 0) of a length divisible by 4, 4 per byte
+    codes = np.where(codes == 4, 0, codes).reshape(-1, 4)
+    return (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | \
+        codes[:, 3]
+
+
+def convert_fasta(fasta_path, output_dir, block_size=2 ** 24):
+    """
+    Write the packed store of a genome FASTA file to `output_dir`: for
+    each chromosome, `<chrom>.seq.npy` holds 4 bases per byte (2 bits per
+    base, ACGT) and `<chrom>.nmask.npy` the packbits mask of N (or any
+    other non-ACGT) bases. Soft-masked (lowercase) bases are stored as
+    their uppercase base. Chromosomes are converted in blocks of
+    `block_size` bases (a multiple of 8).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    fasta_file = pyfaidx.Fasta(fasta_path, sequence_always_upper=False)
+    index = {}
+    for chrom in fasta_file.keys():
+        length = len(fasta_file[chrom])
+        seq = np.lib.format.open_memmap(
+            os.path.join(output_dir, '{0}.seq.npy'.format(chrom)), mode='w+',
+            dtype=np.uint8, shape=((length + 3) // 4,))
+        nmask = np.lib.format.open_memmap(
+            os.path.join(output_dir, '{0}.nmask.npy'.format(chrom)),
+            mode='w+', dtype=np.uint8, shape=((length + 7) // 8,))
+        for s in range(0, length, block_size):
+            e = min(s + block_size, length)
+            block = str(fasta_file[chrom][s:e])
+            codes = _CODE_LUT[np.frombuffer(block.encode(), dtype=np.uint8)]
+            padded = np.full(-(-len(codes) // 8) * 8, 4, dtype=np.uint8)
+            padded[:len(codes)] = codes
+            # the padding of the last block may add one byte too many
+            seq[s // 4:s // 4 + len(padded) // 4] = \
+                _pack_codes(padded)[:len(seq) - s // 4]
+            nmask[s // 8:s // 8 + len(padded) // 8] = np.packbits(padded == 4)
+        seq.flush()
+        nmask.flush()
+        index[chrom] = length
+        print("{0}: {1} bp".format(chrom, length))
+    with open(os.path.join(output_dir, _INDEX_FILE), 'w') as fh:
+        json.dump(index, fh)
+    return output_dir
+
+
+class PackedGenome(object):
+    """
+    A genome store written by `convert_fasta`, memory-mapped read-only.
+    `get_sequence_from_coords` matches selene's `Genome` method of the same
+    name, so a `PackedGenome` can replace a `Genome` in `process_variants`
+    (`./example/utils.py`), `ism.py` and `variant_effects.py`.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory written by `convert_fasta`.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, _INDEX_FILE)) as fh:
+            self.chrom_lengths = json.load(fh)
+        self._arrays = {}
+
+    def _chrom_arrays(self, chrom):
+        if chrom not in self._arrays:
+            self._arrays[chrom] = tuple(
+                np.load(os.path.join(
+                    self.store_dir, '{0}.{1}.npy'.format(chrom, kind)),
+                    mmap_mode='r')
+                for kind in ('seq', 'nmask'))
+        return self._arrays[chrom]
+
+    def get_codes(self, chroms, starts, length):
+        """
+        Base codes (0-3 for ACGT, 4 for N) of the windows
+        `[starts, starts + length)`, as an array of shape
+        (len(starts), length). Positions outside the chromosome are N.
+        """
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        codes = np.full((len(starts), length), 4, dtype=np.uint8)
+        offsets = np.arange(length)
+        for chrom in np.unique(chroms):
+            rows = np.nonzero(chroms == chrom)[0]
+            if chrom not in self.chrom_lengths:
+                continue
+            seq, nmask = self._chrom_arrays(chrom)
+            ix = starts[rows, None] + offsets
+            inside = (ix >= 0) & (ix < self.chrom_lengths[chrom])
+            ix = np.clip(ix, 0, self.chrom_lengths[chrom] - 1)
+            lo = 0
+            span_seq, span_nmask = seq, nmask
+            if ix.max() + 1 - ix.min() <= 4 * ix.size:
+                # dense windows: read the span covering them all at once,
+                # then gather from it, instead of gathering from the map
+                lo = ix.min() - ix.min() % 8
+                span_seq = np.asarray(seq[lo // 4:(ix.max() + 4) // 4])
+                span_nmask = np.asarray(nmask[lo // 8:(ix.max() + 8) // 8])
+            rel = ix - lo
+            base = (span_seq[rel >> 2] >> (6 - 2 * (rel & 3))) & 3
+            is_n = (span_nmask[rel >> 3] >> (7 - (rel & 7))) & 1
+            base[is_n.astype(bool) | ~inside] = 4
+            codes[rows] = base
+        return codes
+
+    def get_windows(self, chroms, centers, seq_len):
+        """
+        Windows `[centers - seq_len // 2, centers + seq_len // 2)` (the
+        windows of `process_variants`) as packbits arrays of shape
+        (N, seq_len / 8, 4), the layout of the training and evaluation
+        datasets (N bases are all ones), and a boolean array marking the
+        windows that lie entirely within their chromosome.
+        """
+        centers = np.asarray(centers, dtype=np.int64)
+        starts = centers - seq_len // 2
+        codes = self.get_codes(chroms, starts, seq_len)
+        onehot = (codes[..., None] == np.arange(4)) | (codes == 4)[..., None]
+        lengths = np.array([self.chrom_lengths.get(c, 0) for c in chroms])
+        valid = (starts >= 0) & (starts + seq_len <= lengths)
+        return np.packbits(onehot, axis=1), valid
+
+    def get_sequence_from_coords(self, chrom, start, end, strand='+'):
+        """
+        The sequence of `[start, end)` on `strand` as an uppercase string,
+        or an empty string if the coordinates are not within the chromosome.
+        """
+        if (chrom not in self.chrom_lengths or start < 0 or
+                end > self.chrom_lengths[chrom] or start >= end):
+            return ''
+        codes = self.get_codes([chrom], [start], end - start)[0]
+        if strand == '-':
+            return np.frombuffer(b'TGCAN', dtype=np.uint8)[
+                codes[::-1]].tobytes().decode()
+        return np.frombuffer(b'ACGTN', dtype=np.uint8)[
+            codes].tobytes().decode()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--fasta",
+        required=True,
+        help="Genome FASTA file to convert"
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Output directory of the packed genome store"
+    )
+    args = parser.parse_args()
+    print(convert_fasta(args.fasta, args.output))
@@ -0,0 +1,221 @@
+"""
+CLI for Wreath variant effect prediction directly from the variant-CpG
+locus BED file built in `./example` (`test.intersect_cpg_seq_context.bed`),
+without writing reference and alternative allele FASTA files. Variants are
+grouped by CpG locus, each locus window is read from the genome once, and
+alternative alleles are predicted incrementally with `VariantEngine`.
+"""
+from collections import Counter
+from collections import defaultdict
+import os
+
+from argparse import ArgumentParser
+import h5py
+import numpy as np
+import pandas as pd
+import torch
+
+from selene_sdk.sequences import Genome
+from selene_sdk.utils import load_path
+
+from ism import load_engine
+from packed_genome import PackedGenome
+
+
+BASE_INDEX = {base: ix for ix, base in enumerate(Genome.BASES_ARR)}
+
+
+def read_loci_to_variants(bed_path, seq_len):
+    """
+    CpG locus (chrom, pos) -> list of variants ('chrom_pos_id_ref_alt')
+    within `seq_len // 2` bp, from a variant-CpG locus BED file, as in
+    `./example/cpg_variants_to_fasta.py`.
+    """
+    loci_df = pd.read_csv(bed_path, sep='\t', header=None)
+    loci_to_variants = defaultdict(list)
+    skip = 0
+    for row in loci_df.itertuples():
+        lc, lp = row._10.split('_')
+        lp = int(lp)
+        # off by 1 extra filtering step
+        if lp - row._2 == seq_len // 2:
+            skip += 1
+            continue
+        loci_to_variants[(lc, lp)].append('{0}_{1}_{2}_{3}_{4}'.format(
+            row._1, row._2, row._4, row._5, row._6))
+    print("Skipped {0} variants at the window boundary".format(skip))
+    return loci_to_variants
+
+
+def substitution_case(base, vref, valt):
+    """
+    How a variant relates to the reference genome `base` at its position
+    (see `substitution` in `./example/utils.py`), as `(info, ref_is_window,
+    sub_base)`: whether the genome window is the reference allele window
+    (otherwise it is the alternative allele window), and the base to
+    substitute into it to get the other allele. `sub_base` is None for
+    'nomatch'.
+    """
+    vref, valt = vref.upper(), valt.upper()
+    complement = Genome.COMPLEMENTARY_BASE_DICT
+    if base == vref:
+        return 'match', True, valt
+    elif base == valt:
+        return 'swap', False, vref
+    elif base == complement.get(vref):
+        return 'complement', True, complement[valt]
+    elif base == complement.get(valt):
+        return 'complement_swap', False, complement[vref]
+    return 'nomatch', None, None
+
+
+def score_locus(engine, query, pos, variants, seq_len):
+    """
+    Reference and alternative allele predictions for the variants around
+    one CpG locus, whose window `query` is centered at `pos`.
+
+    Returns
+    -------
+    labels : list(dict)
+        'variant' and 'sub_info' of every variant; the first `n` are the
+        scored variants and the rest are 'nomatch' variants (or variants
+        substituting an N).
+    ref_preds, alt_preds : torch.Tensor
+        Predictions of shape (n, n_targets) for the scored variants.
+    """
+    window_pred = engine.set_reference(
+        torch.from_numpy(Genome.sequence_to_encoding(query).T.copy()))
+    scored, unscored = [], []
+    offsets, bases, ref_is_window = [], [], []
+    for v in sorted(set(variants)):
+        info = v.split('_')
+        if len(info) == 5:
+            c, p, vid, r, a = info
+        else:
+            c, p, r, a = info
+        sub_pos = int(p) - (pos - seq_len // 2) - 1
+        sub_info, is_ref, sub_base = substitution_case(
+            query[sub_pos].upper(), r, a)
+        label = {'variant': v, 'sub_info': sub_info}
+        if sub_base not in BASE_INDEX:
+            unscored.append(label)
+            continue
+        scored.append(label)
+        offsets.append(sub_pos)
+        bases.append(BASE_INDEX[sub_base])
+        ref_is_window.append(is_ref)
+
+    other = engine.predict(offsets, torch.eye(4)[bases].view(-1, 4))
+    ref_is_window = torch.tensor(
+        ref_is_window, dtype=torch.bool, device=other.device)[:, None]
+    window_pred = window_pred[None].expand_as(other)
+    ref_preds = torch.where(ref_is_window, window_pred, other)
+    alt_preds = torch.where(ref_is_window, other, window_pred)
+    return scored + unscored, ref_preds, alt_preds
+
+
+def append_predictions(datasets, buffers):
+    """
+    Append the buffered ref and alt predictions, and their difference, to
+    the resizable `datasets` and empty the buffers.
+    """
+    if not buffers['ref']:
+        return
+    refs = np.vstack(buffers['ref'])
+    alts = np.vstack(buffers['alt'])
+    s = len(datasets['ref'])
+    for name, values in (('ref', refs), ('alt', alts),
+                         ('diff', alts - refs)):
+        datasets[name].resize(s + len(values), axis=0)
+        datasets[name][s:] = values
+    buffers['ref'], buffers['alt'] = [], []
+    print("Scored {0} variants".format(s + len(refs)))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--yaml",
+        required=True,
+        help="Input YAML configuration file path, e.g. ./fasta.yaml"
+    )
+    parser.add_argument(
+        "--input",
+        required=True,
+        help="Input BED file with variant and CpG information, see "
+             "./example/README.md"
+    )
+    parser.add_argument(
+        "--genome",
+        required=True,
+        help="Reference genome FASTA, e.g. ../resources/hg19_UCSC.fa, or a "
+             "genome store directory written by packed_genome.py"
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Output .h5 file path"
+    )
+    parser.add_argument(
+        "--cuda",
+        action="store_true",
+        help="Use CUDA for processing"
+    )
+    args = parser.parse_args()
+
+    configs = load_path(args.yaml, instantiate=False)
+    seq_len = configs["model"]["class_args"]["sequence_length"]
+    n_targets = configs["model"]["class_args"]["n_genomic_features"]
+    engine = load_engine(configs, use_cuda=args.cuda)
+    genome = PackedGenome(args.genome) if os.path.isdir(args.genome) \
+        else Genome(args.genome)
+    loci_to_variants = read_loci_to_variants(args.input, seq_len)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    labels = []
+    counts = Counter()
+    buffers = {'ref': [], 'alt': []}
+
+    with h5py.File(args.output, 'w') as write_fh:
+        datasets = {
+            name: write_fh.create_dataset(
+                name, (0, n_targets), maxshape=(None, n_targets),
+                chunks=(256, n_targets), dtype=np.float32)
+            for name in ('ref', 'alt', 'diff')}
+        n_buffered = 0
+        for (chrom, pos), variants in loci_to_variants.items():
+            query = genome.get_sequence_from_coords(
+                chrom, pos - seq_len // 2, pos + seq_len // 2)
+            if len(query) != seq_len:
+                print("Skipping: ({0} {1}), seq len = {2}".format(
+                    chrom, pos, len(query)))
+                continue
+            if query[seq_len // 2 - 1].upper() != 'C':
+                counts['locus_mismatch'] += len(set(variants))
+                continue
+            locus_labels, ref_preds, alt_preds = score_locus(
+                engine, query, pos, variants, seq_len)
+            counts.update(row['sub_info'] for row in locus_labels)
+            contains_unk = 'N' in query.upper()
+            for row in locus_labels[:len(ref_preds)]:
+                row['loci'] = '{0}_{1}'.format(chrom, pos)
+                row['contains_unk'] = contains_unk
+                labels.append(row)
+            buffers['ref'].append(ref_preds.cpu().numpy())
+            buffers['alt'].append(alt_preds.cpu().numpy())
+            n_buffered += len(ref_preds)
+            if n_buffered >= 8192:
+                append_predictions(datasets, buffers)
+                n_buffered = 0
+        append_predictions(datasets, buffers)
+    print(counts)
+
+    labels_out = '{0}_row_labels.txt'.format(args.output.rsplit('.', 1)[0])
+    labels = pd.DataFrame(labels, columns=[
+        'loci', 'variant', 'sub_info', 'contains_unk'])
+    labels.index.name = 'index'
+    labels.to_csv(labels_out, sep='\t')
+    print(args.output)
+    print(labels_out)
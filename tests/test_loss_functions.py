@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+import torch
+
+pytest.importorskip('torchsort')
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'train'))
+from loss_functions import spearman_by_track_default
+from loss_functions import spearman_by_track_loop
+
+
+ALL_NAN, CONSTANT = 2, 4
+
+
+def make_batch(n=32, n_targets=6, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    pred = torch.rand(n, n_targets, generator=generator,
+                      dtype=torch.float64)
+    target = torch.rand(n, n_targets, generator=generator,
+                        dtype=torch.float64)
+    target[torch.rand(n, n_targets, generator=generator) < 0.3] = \
+        float('nan')
+    target[:, ALL_NAN] = float('nan')
+    # a single distinct valid value, for which the correlation is undefined
+    target[:, CONSTANT] = torch.where(
+        torch.isnan(target[:, CONSTANT]), target[:, CONSTANT],
+        torch.full_like(target[:, CONSTANT], 0.5))
+    return pred, target
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_spearman_by_track_matches_loop(seed):
+    pred, target = make_batch(seed=seed)
+    expected = spearman_by_track_loop(pred, target)
+    observed = spearman_by_track_default(pred, target)
+    assert torch.isfinite(observed)
+    assert torch.allclose(observed, expected.to(observed.dtype), atol=1e-6)
+
+
+def test_spearman_by_track_gradients_match_loop():
+    pred, target = make_batch()
+    pred_loop = pred.clone().requires_grad_()
+    spearman_by_track_loop(pred_loop, target).backward()
+    pred_batched = pred.clone().requires_grad_()
+    spearman_by_track_default(pred_batched, target).backward()
+
+    # the loop's gradients are NaN for the constant track only
+    finite = torch.isfinite(pred_loop.grad).all(dim=0)
+    assert finite.tolist() == [ix != CONSTANT for ix in range(pred.size(1))]
+    assert torch.allclose(pred_batched.grad[:, finite],
+                          pred_loop.grad[:, finite], atol=1e-6)
+    assert (pred_batched.grad[:, ALL_NAN] == 0).all()
+    assert (pred_batched.grad[:, CONSTANT] == 0).all()
@@ -0,0 +1,60 @@
+import logging
+import os
+import sys
+
+import pytest
+import torch
+import torch.nn as nn
+
+pytest.importorskip('selene_sdk')
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'train'))
+from trainer import AMPTrainModel
+
+
+def make_trainer(precision, scaler_enabled, output_dir):
+    # an `AMPTrainModel` with only the state used to save and resume
+    trainer = AMPTrainModel.__new__(AMPTrainModel)
+    torch.manual_seed(0)
+    trainer.model = nn.Linear(4, 2)
+    trainer.optimizer = torch.optim.SGD(
+        trainer.model.parameters(), lr=0.1, momentum=0.9)
+    trainer.max_steps = 100
+    trainer.use_cuda = False
+    trainer.output_dir = str(output_dir)
+    trainer.precision = precision
+    # fp16 training scales the loss on CUDA; a CPU scaler stands in for it
+    trainer.scaler = torch.amp.GradScaler('cpu', enabled=scaler_enabled)
+    return trainer
+
+
+def save_checkpoint(trainer):
+    trainer._save_checkpoint(
+        {'state_dict': trainer.model.state_dict(), 'step': 10,
+         'min_loss': 0.5, 'optimizer': trainer.optimizer.state_dict()},
+        False)
+    return os.path.join(trainer.output_dir, 'checkpoint.pth.tar')
+
+
+def test_resume_fp32_checkpoint_at_fp16(tmp_path, caplog):
+    path = save_checkpoint(make_trainer('fp32', False, tmp_path))
+    assert torch.load(path)['scaler'] == {}
+
+    trainer = make_trainer('fp16', True, tmp_path)
+    scale = trainer.scaler.get_scale()
+    with caplog.at_level(logging.WARNING, logger='selene'):
+        trainer._load_checkpoint(path)
+    assert trainer.step == 10
+    assert trainer.scaler.get_scale() == scale
+    assert 'trained at fp32 precision, resuming at fp16' in caplog.text
+
+
+def test_resume_fp16_checkpoint_restores_scaler(tmp_path, caplog):
+    saved = make_trainer('fp16', True, tmp_path)
+    saved.scaler = torch.amp.GradScaler('cpu', init_scale=128.)
+    path = save_checkpoint(saved)
+
+    trainer = make_trainer('fp16', True, tmp_path)
+    with caplog.at_level(logging.WARNING, logger='selene'):
+        trainer._load_checkpoint(path)
+    assert trainer.scaler.get_scale() == 128.
+    assert 'resuming at' not in caplog.text
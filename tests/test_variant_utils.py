@@ -0,0 +1,58 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('selene_sdk')
+from selene_sdk.sequences import Genome
+
+# loaded under its own name, as ../train/utils.py is also named `utils`
+_spec = importlib.util.spec_from_file_location(
+    'predict_example_utils', os.path.join(
+        os.path.dirname(__file__), '..', 'predict', 'example', 'utils.py'))
+variant_utils = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(variant_utils)
+
+
+WINDOW = 'ACGTCAGTACGTAcgtNNACGTACGTACGTAC'
+
+
+def pack(sequence):
+    return np.packbits(Genome.sequence_to_encoding(sequence) > 0, axis=0)
+
+
+def test_base_indices():
+    indices = variant_utils.base_indices(
+        ['A', 'c', 'G', 't', 'N', 'r', '-', '*', '.', 'AT', ''])
+    assert indices.tolist() == [0, 1, 2, 3, -1, -1, -2, -2, -2, -2, -2]
+
+
+@pytest.mark.parametrize('packed', [True, False])
+def test_substitute_encoded_matches_substitution(packed):
+    # offsets and alleles covering every case, an N window base, an N alt
+    # allele and alleles that are not base substitutions
+    variants = [(4, 'C', 'T'), (4, 'T', 'C'), (4, 'G', 'A'), (4, 'A', 'G'),
+                (4, 'A', 'T'), (16, 'N', 'A'), (5, 'A', 'N'),
+                (13, 'C', 'CT'), (13, 'T', '-'), (14, 'G', '*')]
+    window = pack(WINDOW) if packed else \
+        Genome.sequence_to_encoding(WINDOW)
+    refs, alts, info = variant_utils.substitute_encoded(
+        window, [o for o, _, _ in variants], [r for _, r, _ in variants],
+        [a for _, _, a in variants], packed=packed)
+    encode = pack if packed else Genome.sequence_to_encoding
+    for ix, (offset, vref, valt) in enumerate(variants):
+        # unlike `substitution`, N window bases are never matched
+        if len(vref) == len(valt) == 1 and valt.upper() in 'ACGTN' and \
+                vref.upper() in 'ACGTN' and WINDOW[offset] != 'N':
+            ref, alt, expected = variant_utils.substitution(
+                WINDOW, len(WINDOW) // 2, 'chr1',
+                offset + 1, vref, valt)
+        else:
+            ref, alt, expected = None, None, 'nomatch'
+        assert info[ix] == expected, (variants[ix], info[ix])
+        if expected == 'nomatch':
+            assert (refs[ix] == window).all() and (alts[ix] == window).all()
+        else:
+            assert (refs[ix] == encode(ref)).all()
+            assert (alts[ix] == encode(alt)).all()
@@ -0,0 +1,178 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'model'))
+from wreath import FusedConvPair
+from wreath import FusedSplineHead
+from wreath import VariantEngine
+from wreath import Wreath
+from wreath import _bs_knots
+from wreath import bspline_basis
+from wreath import bspline_basis_torch
+from wreath import fuse_for_inference
+from wreath import spline_factory
+
+
+SEQUENCE_LENGTH = 256
+N_FEATURES = 8
+
+
+def make_model(**kwargs):
+    torch.manual_seed(0)
+    return Wreath(sequence_length=SEQUENCE_LENGTH,
+                  n_genomic_features=N_FEATURES, **kwargs).eval()
+
+
+def random_sequences(n, length):
+    idx = torch.randint(4, (n, length))
+    return F.one_hot(idx, 4).transpose(1, 2).float()
+
+
+@pytest.mark.parametrize('strand_average', [False, True])
+def test_scan_region_matches_forward(strand_average):
+    model = make_model(strand_average=strand_average)
+    region = random_sequences(1, 900)[0]
+    # several pooling phases, windows sharing a trunk pass, and windows
+    # split into separate passes by batch_size and chunk_size
+    starts = [0, 3, 16, 37, 100, 116, 132, 644]
+    with torch.no_grad():
+        expected = model(torch.stack(
+            [region[:, s:s + SEQUENCE_LENGTH] for s in starts]))
+    observed = model.scan_region(region, starts, batch_size=2,
+                                 chunk_size=64)
+    assert torch.allclose(observed, expected, atol=1e-5)
+
+
+def test_scan_region_rejects_windows_outside_region():
+    model = make_model()
+    region = random_sequences(1, 300)[0]
+    with pytest.raises(ValueError):
+        model.scan_region(region, [100])
+
+
+@pytest.mark.parametrize('kernel_sizes', [(9, 9), (5, 3)])
+@pytest.mark.parametrize('length', [20, 101, 128])
+def test_fused_conv_pair_matches_unfused(kernel_sizes, length):
+    torch.manual_seed(0)
+    k1, k2 = kernel_sizes
+    first = nn.Conv1d(4, 6, kernel_size=k1, padding=k1 // 2)
+    second = nn.Conv1d(6, 5, kernel_size=k2, padding=k2 // 2)
+    fused = FusedConvPair(first, second)
+    # lengths above 2 * _strip take the fused path with recomputed edges
+    x = torch.randn(3, 4, length)
+    with torch.no_grad():
+        assert torch.allclose(fused(x), second(first(x)), atol=1e-5)
+
+
+def test_fused_conv_pair_rejects_dilated_convolutions():
+    first = nn.Conv1d(4, 6, kernel_size=5, dilation=2, padding=4)
+    second = nn.Conv1d(6, 5, kernel_size=3, padding=1)
+    with pytest.raises(ValueError):
+        FusedConvPair(first, second)
+
+
+@pytest.mark.parametrize('length', [SEQUENCE_LENGTH, SEQUENCE_LENGTH - 1])
+def test_fuse_for_inference_matches_unfused(length):
+    model = make_model()
+    fused = fuse_for_inference(model, verify=False)
+    assert not any(isinstance(m, nn.Dropout) for m in fused.modules())
+    assert sum(isinstance(m, FusedConvPair) for m in fused.modules()) == 3
+    x = random_sequences(2, length)
+    with torch.no_grad():
+        assert torch.allclose(fused(x), model(x), atol=1e-5)
+
+
+@pytest.mark.parametrize('spatial_dim', [16, 40])
+def test_fused_spline_head_matches_unfused(spatial_dim):
+    torch.manual_seed(0)
+    model = Wreath(sequence_length=SEQUENCE_LENGTH,
+                   n_genomic_features=64).eval()
+    head = FusedSplineHead(model.spline_tr, model.classifier)
+    # 16 * 64 < 16 * (16 + 64) folds; 40 * 64 > 16 * (40 + 64) does not
+    assert head.folds(spatial_dim) == (spatial_dim == 16)
+    out = torch.randn(2, 960, spatial_dim)
+    with torch.no_grad():
+        assert torch.allclose(head(out), model.head(out), atol=1e-5)
+    name = 'folded_weight_{0}'.format(spatial_dim)
+    assert (name in dict(head.named_buffers())) == head.folds(spatial_dim)
+
+
+def test_fused_spline_head_weights_are_nonpersistent_buffers():
+    model = make_model()
+    head = FusedSplineHead(model.spline_tr, model.classifier)
+    with torch.no_grad():
+        head(torch.randn(1, 960, 16))
+    assert 'folded_weight_16' not in head.state_dict()
+    head.double()
+    assert head.folded_weight_16.dtype == torch.float64
+
+
+def test_fuse_for_inference_fold_spline_matches_unfused():
+    model = make_model()
+    fused = fuse_for_inference(model, fold_spline=True, verify=False)
+    x = random_sequences(2, SEQUENCE_LENGTH)
+    with torch.no_grad():
+        assert torch.allclose(fused(x), model(x), atol=1e-5)
+
+
+@pytest.mark.parametrize('n, df', [(16, 16), (128, 16), (37, 8)])
+def test_bspline_basis_matches_splev(n, df):
+    interpolate = pytest.importorskip('scipy.interpolate')
+    x = np.arange(n, dtype=float)
+    knots = _bs_knots(x, df=df, intercept=True)
+    n_basis = len(knots) - 4
+    expected = np.stack([
+        interpolate.splev(x, (knots, np.eye(n_basis)[i], 3))
+        for i in range(n_basis)], axis=1)
+    observed = bspline_basis(x, knots)
+    assert np.allclose(observed, expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('log', [False, True])
+def test_bspline_basis_torch_matches_numpy(log):
+    x = np.arange(64, dtype=float) - 32
+    if log:
+        x = np.log(np.abs(x) + 1) * (2 * (x > 0) - 1)
+    knots = _bs_knots(x, df=12, intercept=True)
+    observed = bspline_basis_torch(torch.from_numpy(x),
+                                   torch.from_numpy(knots))
+    assert np.allclose(observed.numpy(), bspline_basis(x, knots),
+                       rtol=0, atol=1e-12)
+
+
+def test_spline_factory_caches_per_length_and_dtype():
+    basis = spline_factory(48, 16)
+    assert basis.shape == (48, 16)
+    assert basis.dtype == torch.float32
+    assert spline_factory(48, 16) is basis
+    double = spline_factory(48, 16, dtype=torch.float64)
+    assert double is not basis
+    assert torch.allclose(double.float(), basis)
+    scaled = spline_factory(48, 16, scaled=True)
+    assert torch.allclose(scaled, basis / 48)
+
+
+@pytest.mark.parametrize('strand_average', [False, True])
+@pytest.mark.parametrize('width', [1, 3])
+def test_variant_engine_matches_forward(strand_average, width):
+    model = make_model(strand_average=strand_average)
+    ref = random_sequences(1, SEQUENCE_LENGTH)[0]
+    # substitutions at both window boundaries and in the interior
+    positions = [0, 1, 77, 128, SEQUENCE_LENGTH - width]
+    alts = random_sequences(len(positions), width)
+    engine = VariantEngine(model, batch_size=2)
+    ref_pred = engine.set_reference(ref)
+    observed = engine.predict(positions, alts if width > 1 else alts[..., 0])
+
+    mutated = ref.repeat(len(positions), 1, 1)
+    for ix, pos in enumerate(positions):
+        mutated[ix, :, pos:pos + width] = alts[ix]
+    with torch.no_grad():
+        assert torch.allclose(ref_pred, model(ref[None])[0], atol=1e-5)
+        assert torch.allclose(observed, model(mutated), atol=1e-5)
@@ -0,0 +1,248 @@
+"""
+Benchmark the step time (forward and backward) of the loss functions in
+`loss_functions.py` on random predictions and NaN-masked targets shaped
+like the Berry training batches, e.g.
+
+    python benchmark.py --device=cuda --batch-size=128 --nan-fraction=0.6
+
+or, with a training YAML file, of full training steps of its model and loss
+at each autocast precision and activation checkpointing setting, e.g.
+
+    python benchmark.py --config=train.yaml --device=cuda --batch-size=64 \
+        --precisions fp32 bf16 --checkpoint-blocks none conv1,conv2 all
+"""
+from argparse import ArgumentParser
+import time
+
+import torch
+import yaml
+
+from loss_functions import masked_mse
+from loss_functions import MaskedMSELoss
+from loss_functions import MaskedPearsonLoss
+from loss_functions import MaskedSpearmanLoss
+from loss_functions import mse
+from loss_functions import spearman_by_track_default
+from loss_functions import spearman_by_track_loop
+from trainer import amp_step
+from utils import autocast
+from utils import load_model_arch
+from utils import PRECISIONS
+from utils import resolve_precision
+
+
+LOSSES = {
+    'mse': mse,
+    'masked_mse': masked_mse,
+    'MaskedMSELoss': MaskedMSELoss(),
+    'MaskedPearsonLoss': MaskedPearsonLoss(),
+    'spearman_by_track_loop': spearman_by_track_loop,
+    'spearman_by_track_default': spearman_by_track_default,
+    'MaskedSpearmanLoss': MaskedSpearmanLoss(),
+}
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_loss(loss_fn, pred, target, steps, warmup):
+    """
+    Mean seconds per forward and backward pass of `loss_fn`, and the loss.
+    """
+    for _ in range(warmup):
+        pred.grad = None
+        loss_fn(pred, target).backward()
+    _synchronize(pred.device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        pred.grad = None
+        loss = loss_fn(pred, target)
+        loss.backward()
+    _synchronize(pred.device)
+    return (time.perf_counter() - start) / steps, loss.item()
+
+
+def time_train_step(model, criterion, optimizer, inputs, targets, precision,
+                    steps, warmup):
+    """
+    Mean seconds per training step (see `trainer.amp_step`) of `model` at
+    `precision`, and the last loss.
+    """
+    device = inputs.device
+    scaler = torch.amp.GradScaler(device.type, enabled=precision == 'fp16')
+    model.train()
+    for _ in range(warmup):
+        amp_step(model, criterion, optimizer, scaler, inputs, targets,
+                 precision, device)
+    _synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        loss = amp_step(model, criterion, optimizer, scaler, inputs, targets,
+                        precision, device)
+    _synchronize(device)
+    return (time.perf_counter() - start) / steps, loss.item()
+
+
+def _parameter_cast(tensor, parameters):
+    # whether `tensor` is a copy of a parameter, e.g. an autocast weight
+    # cast or its transpose: following its single autograd inputs leads to
+    # a cast of the parameter's gradient accumulator
+    grad_fn = tensor.grad_fn
+    while grad_fn is not None:
+        inputs = [fn for fn, _ in grad_fn.next_functions if fn is not None]
+        if type(grad_fn).__name__ == 'ToCopyBackward0':
+            return any(id(getattr(fn, 'variable', None)) in parameters
+                       for fn in inputs)
+        if len(inputs) != 1:
+            return False
+        grad_fn = inputs[0]
+    return False
+
+
+def activation_memory(model, inputs, precision):
+    """
+    Bytes of the tensors other than parameters and their autocast casts
+    that one forward pass of `model` at `precision` saves for the backward
+    pass, counting each storage once: the activation memory that
+    `checkpoint_blocks` reduces, comparable across precisions.
+    """
+    parameters = {id(p) for p in model.parameters()}
+    parameter_storages = {p.untyped_storage().data_ptr()
+                          for p in model.parameters()}
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if (storage.data_ptr() not in parameter_storages and
+                not _parameter_cast(tensor, parameters)):
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    model.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        with autocast(precision, inputs.device):
+            model(inputs)
+    return sum(storages.values())
+
+
+def benchmark_training(config, device, batch_size, n_targets, nan_fraction,
+                       precisions, steps, warmup, checkpoint_settings=None):
+    """
+    Print the training step time, throughput and activation memory (and
+    the peak memory on CUDA) of the model and loss in the training YAML
+    file `config` at each of `precisions`, for each of
+    `checkpoint_settings` ('none', 'all' or comma-separated block names
+    for the `checkpoint_blocks` class argument; default is the setting in
+    `config`).
+    """
+    from train import LOSS_FN
+
+    with open(config) as f:
+        setup_args = yaml.safe_load(f)
+    seq_len = setup_args.get('seq_len', 4096)
+    model_configs = setup_args['model']
+    model_configs.setdefault('class_args', {})
+    model_configs['class_args']['sequence_length'] = seq_len
+    model_configs['class_args']['n_genomic_features'] = n_targets
+    criterion = LOSS_FN[setup_args['loss']]
+
+    inputs = torch.eye(4, device=device)[
+        torch.randint(4, (batch_size, seq_len), device=device)].transpose(1, 2)
+    targets = torch.rand(batch_size, n_targets, device=device)
+    targets[torch.rand_like(targets) < nan_fraction] = float('nan')
+
+    print("{0:<24}{1:<12}{2:>12}{3:>16}{4:>16}{5:>12}{6:>12}".format(
+        "checkpoint_blocks", "precision", "ms/step", "sequences/s",
+        "activation MB", "peak MB", "loss"))
+    for setting in checkpoint_settings or [None]:
+        class_args = model_configs['class_args']
+        if setting is not None:
+            class_args['checkpoint_blocks'] = \
+                None if setting == 'none' else \
+                setting if setting == 'all' else setting.split(',')
+        label = class_args.get('checkpoint_blocks') or 'none'
+        if not isinstance(label, str):
+            label = ','.join(label)
+        model, optim_class, optim_kwargs = load_model_arch(
+            model_configs, lr=setup_args.get('lr', 0.01))
+        model.to(device)
+        optimizer = optim_class(model.parameters(), **optim_kwargs)
+        for precision in precisions:
+            precision = resolve_precision(precision, device)
+            activations = activation_memory(model, inputs, precision)
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            seconds, loss = time_train_step(
+                model, criterion, optimizer, inputs, targets, precision,
+                steps, warmup)
+            peak = '-'
+            if device.type == 'cuda':
+                peak = '{0:.0f}'.format(
+                    torch.cuda.max_memory_allocated(device) / 2 ** 20)
+            print("{0:<24}{1:<12}{2:>12.1f}{3:>16.1f}{4:>16.0f}{5:>12}"
+                  "{6:>12.5f}".format(
+                      label, precision, seconds * 1e3, batch_size / seconds,
+                      activations / 2 ** 20, peak, loss))
+        del model, optimizer
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--device", help="Device to benchmark on, default is cpu",
+        default="cpu")
+    parser.add_argument(
+        "--batch-size", help="Batch size, default is 128",
+        default=128, type=int)
+    parser.add_argument(
+        "--n-targets", help="Number of targets, default is 296",
+        default=296, type=int)
+    parser.add_argument(
+        "--nan-fraction", help="Fraction of NaN targets, default is 0.6",
+        default=0.6, type=float)
+    parser.add_argument(
+        "--steps", help="Number of timed steps per loss, default is 20",
+        default=20, type=int)
+    parser.add_argument(
+        "--warmup", help="Number of untimed steps per loss, default is 3",
+        default=3, type=int)
+    parser.add_argument(
+        "--losses", nargs="+", choices=sorted(LOSSES.keys()),
+        help="Losses to benchmark, default is all", default=None)
+    parser.add_argument(
+        "--config",
+        help="A training .yaml file; benchmark training steps of its model "
+             "and loss instead of the losses alone",
+        default=None)
+    parser.add_argument(
+        "--precisions", nargs="+", choices=sorted(PRECISIONS.keys()),
+        help="Autocast precisions of the --config training steps, default "
+             "is fp32 and bf16", default=["fp32", "bf16"])
+    parser.add_argument(
+        "--checkpoint-blocks", nargs="+",
+        help="Activation checkpointing settings of the --config model to "
+             "compare: 'none', 'all' or comma-separated trunk block names "
+             "(e.g. conv1,conv2,conv3), default is the config's setting",
+        default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.config:
+        benchmark_training(
+            args.config, device, args.batch_size, args.n_targets,
+            args.nan_fraction, args.precisions, args.steps, args.warmup,
+            checkpoint_settings=args.checkpoint_blocks)
+        raise SystemExit
+    torch.manual_seed(0)
+    target = torch.rand(args.batch_size, args.n_targets, device=device)
+    target[torch.rand_like(target) < args.nan_fraction] = float('nan')
+    pred = torch.rand(args.batch_size, args.n_targets, device=device,
+                      requires_grad=True)
+
+    print("{0:<28}{1:>12}{2:>12}".format("loss", "ms/step", "value"))
+    for name in args.losses or LOSSES.keys():
+        seconds, value = time_loss(
+            LOSSES[name], pred, target, args.steps, args.warmup)
+        print("{0:<28}{1:>12.3f}{2:>12.5f}".format(name, seconds * 1e3, value))
@@ -12,6 +12,33 @@ def mse(pred, target):
     return F.mse_loss(pred[~mask], target[~mask])
 
 
+def masked_mse(pred, target):
+    """
+    `mse` as a weighted reduction over the dense mask of non-NaN targets,
+    without materializing (and synchronizing on the size of) the selected
+    elements.
+    """
+    weight = (~torch.isnan(target)).to(pred.dtype)
+    diff = (pred - torch.nan_to_num(target)) * weight
+    return (diff * diff).sum() / weight.sum()
+
+
+def _track_correlations(x, y, weight):
+    """
+    Pearson correlation of each row of `x` and `y` over the entries with
+    weight 1, and whether it is defined (both rows vary over them). The
+    correlation is 0 where it is not defined, with finite gradients.
+    """
+    count = weight.sum(dim=1, keepdim=True).clamp(min=1)
+    x = (x - (x * weight).sum(dim=1, keepdim=True) / count) * weight
+    y = (y - (y * weight).sum(dim=1, keepdim=True) / count) * weight
+    x_norm = x.norm(dim=1)
+    y_norm = y.norm(dim=1)
+    defined = (x_norm > 0) & (y_norm > 0)
+    denom = torch.where(defined, x_norm * y_norm, torch.ones_like(x_norm))
+    return (x * y).sum(dim=1) / denom, defined
+
+
 def spearman_ts_default(pred, target, **kw):
     pred = torchsort.soft_rank(pred, **kw)
     target = torchsort.soft_rank(target, **kw)
@@ -23,7 +50,100 @@ def spearman_ts_default(pred, target, **kw):
     return -1 * rho
 
 
-def spearman_by_track_default(pred, target):
+def spearman_by_track_default(pred, target, **kw):
+    """
+    Negative soft Spearman correlation of each track (column) over the
+    non-NaN targets of the batch, averaged over the tracks. All tracks of
+    `pred` and `target` are soft-ranked in a single `torchsort.soft_rank`
+    call: NaN entries are replaced by constants ranked above every valid
+    entry, which leaves the soft ranks of the valid entries (and their
+    gradients) the same as ranking them alone, and are then masked out of
+    the correlation. As in `spearman_by_track_loop`, tracks without valid
+    targets count as a correlation of 0, and tracks with a single distinct
+    valid value are ignored. Unlike in `spearman_by_track_loop`, whose
+    gradients for such a track are NaN (its NaN correlation is only dropped
+    by `nanmean`), the gradients of ignored tracks are 0, so that a batch
+    with a constant track does not turn the parameters into NaN.
+    """
+    valid = ~torch.isnan(target)
+    values = torch.cat([pred, target], dim=1).t()
+    mask = torch.cat([valid, valid], dim=1).t()
+    # each padding constant exceeds the largest valid entry of its row by
+    # more than the rank range, so the padding forms its own top block
+    strength = kw.get('regularization_strength', 1.0)
+    filled = torch.where(mask, values, values.new_tensor(float('-inf')))
+    top = filled.max(dim=1, keepdim=True)[0].detach()
+    top = torch.where(torch.isfinite(top), top, torch.zeros_like(top))
+    pad = top + 2 * strength * (values.size(1) + 1)
+    ranks = torchsort.soft_rank(torch.where(mask, values, pad), **kw)
+
+    weight = valid.t().to(ranks.dtype)
+    rho, defined = _track_correlations(*ranks.chunk(2), weight)
+    empty = weight.sum(dim=1) == 0
+    corrs = torch.where(
+        defined, -rho,
+        torch.where(empty, torch.zeros_like(rho),
+                    torch.full_like(rho, float('nan'))))
+    return corrs.nanmean()
+
+
+def pearson_by_track(pred, target):
+    """
+    Negative Pearson correlation of each track over the non-NaN targets of
+    the batch, averaged over the tracks where it is defined.
+    """
+    weight = (~torch.isnan(target)).t().to(pred.dtype)
+    rho, defined = _track_correlations(
+        pred.t(), torch.nan_to_num(target).t(), weight)
+    return torch.where(defined, -rho,
+                       torch.full_like(rho, float('nan'))).nanmean()
+
+
+class MaskedMSELoss(nn.Module):
+    """
+    Mean squared error over the non-NaN targets, see `masked_mse`.
+    """
+
+    def forward(self, pred, target):
+        return masked_mse(pred, target)
+
+
+class MaskedPearsonLoss(nn.Module):
+    """
+    Negative mean by-track Pearson correlation over the non-NaN targets,
+    see `pearson_by_track`.
+    """
+
+    def forward(self, pred, target):
+        return pearson_by_track(pred, target)
+
+
+class MaskedSpearmanLoss(nn.Module):
+    """
+    Negative mean by-track soft Spearman correlation over the non-NaN
+    targets, see `spearman_by_track_default`.
+
+    Parameters
+    ----------
+    regularization_strength : float
+        `torchsort.soft_rank` regularization strength.
+    """
+
+    def __init__(self, regularization_strength=1.0):
+        super(MaskedSpearmanLoss, self).__init__()
+        self.regularization_strength = regularization_strength
+
+    def forward(self, pred, target):
+        return spearman_by_track_default(
+            pred, target,
+            regularization_strength=self.regularization_strength)
+
+
+def spearman_by_track_loop(pred, target):
+    """
+    Reference implementation of `spearman_by_track_default`, ranking each
+    track separately.
+    """
     n_targets = target.size()[1]
     corrs = torch.zeros(n_targets)
     for c in torch.arange(n_targets):
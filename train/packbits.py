@@ -0,0 +1,132 @@
+"""
+Decoding of the packbits sequence datasets, where `sequences` has shape
+(N, L / 8, 4): the one-hot (L, 4) encoding of each sequence packed along
+the sequence axis with `np.packbits(..., axis=-2)`, N bases being encoded
+as all ones.
+"""
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+# byte value -> its 8 bits, most significant first as in `np.unpackbits`
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+
+# (dtype, device) -> (bit values, N scale) lookup tables of shape (256, 8)
+_LUTS = {}
+
+
+def _luts(dtype, device):
+    key = (dtype, device)
+    if key not in _LUTS:
+        bits = torch.from_numpy(_BYTE_BITS)
+        # a bit set in all four channels marks an N, which decodes to 0.25
+        _LUTS[key] = (
+            bits.to(device=device, dtype=dtype),
+            torch.where(bits.bool(), 0.25, 1.).to(device=device, dtype=dtype))
+    return _LUTS[key]
+
+
+def decode_packbits(packed, seq_len=None, data_seq_len=None,
+                    dtype=torch.float32, device=None, out=None):
+    """
+    Decode packbits sequences into the model input layout (N, 4, L).
+
+    The centered `seq_len` window is cropped from the packed bytes before
+    decoding, and each byte is expanded through a 256-entry lookup table
+    straight into `dtype`, with N bases set to 0.25 in all channels.
+
+    Parameters
+    ----------
+    packed : numpy.ndarray or torch.Tensor
+        uint8 array of shape (N, data_seq_len / 8, 4), or (data_seq_len / 8,
+        4) for a single sequence.
+    seq_len : int or None
+        Length of the centered window to decode, default is the whole
+        sequence.
+    data_seq_len : int or None
+        Length of the packed sequences, default is 8 times the number of
+        packed bytes.
+    dtype : torch.dtype
+        Output dtype, e.g. torch.float32 or torch.bfloat16.
+    device : torch.device or None
+        Device to decode on, default is that of `packed` (the CPU for
+        numpy arrays).
+    out : torch.Tensor or None
+        Optional preallocated (e.g. pinned) output tensor of shape
+        (N, 4, seq_len) and dtype `dtype` on `device`.
+
+    Returns
+    -------
+    torch.Tensor
+        Decoded sequences of shape (N, 4, seq_len), or (4, seq_len).
+    """
+    packed = torch.as_tensor(packed, device=device)
+    single = packed.dim() == 2
+    if single:
+        packed = packed[None]
+    if data_seq_len is None:
+        data_seq_len = packed.size(1) * 8
+    if seq_len is None:
+        seq_len = data_seq_len
+    start = data_seq_len // 2 - seq_len // 2
+    offset = start % 8
+    cropped = packed[:, start // 8:(start + seq_len + 7) // 8].long()
+
+    bits, n_scale = _luts(dtype, packed.device)
+    values = bits[cropped.transpose(1, 2)].flatten(2)
+    is_n = cropped[..., 0] & cropped[..., 1] & cropped[..., 2] & \
+        cropped[..., 3]
+    scale = n_scale[is_n].flatten(1)
+    out = torch.mul(values[..., offset:offset + seq_len],
+                    scale[:, None, offset:offset + seq_len], out=out)
+    return out[0] if single else out
+
+
+class PackedInputModel(nn.Module):
+    """
+    Wraps a model so that it takes packbits batches of shape
+    (N, data_seq_len / 8, 4) and dtype uint8, decoded with `decode_packbits`
+    on the model's device. Moving packed batches to the device transfers
+    half a byte per base instead of 16 (float32), and on the CPU saves the
+    separate decode into a float batch.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model taking (N, 4, seq_len) inputs.
+    seq_len : int
+        Length of the centered window passed to `model`.
+    data_seq_len : int
+        Length of the packed sequences.
+    dtype : torch.dtype
+        Input dtype of `model`.
+    """
+
+    def __init__(self, model, seq_len, data_seq_len, dtype=torch.float32):
+        super(PackedInputModel, self).__init__()
+        self.model = model
+        self._seq_len = seq_len
+        self._data_seq_len = data_seq_len
+        self._dtype = dtype
+
+    def forward(self, packed):
+        return self.model(decode_packbits(
+            packed, self._seq_len, self._data_seq_len, dtype=self._dtype))
+
+
+def unpackbits_sequence(sequence, s_len):
+    """
+    Unpack packbits sequences of shape (..., L / 8, 4) into float64 arrays
+    of shape (..., s_len, 4) holding the first `s_len` bases. Use
+    `decode_packbits` for model inputs.
+    """
+    sequence = np.unpackbits(sequence.astype(np.uint8), axis=-2)
+    nulls = np.sum(sequence, axis=-1) == sequence.shape[-1]
+    sequence = sequence.astype(float)
+    sequence[nulls, :] = 1.0 / sequence.shape[-1]
+    if sequence.ndim == 3:
+        sequence = sequence[:, :s_len, :]
+    else:
+        sequence = sequence[:s_len, :]
+    return sequence
@@ -0,0 +1,194 @@
+"""
+Distributed data parallel training of Wreath, one process per GPU (or, with
+the gloo backend, per CPU process), launched with `torchrun`, e.g.
+
+    torchrun --nproc_per_node=4 train_ddp.py --config=./train.yaml --lr=0.1
+
+`batch_size` in the configuration is the total over all processes, as
+with `data_parallel: True` in `train.py`.
+"""
+from argparse import ArgumentParser
+import os
+import random
+import string
+from time import strftime
+
+import numpy as np
+from scipy.stats import pearsonr
+from scipy.stats import spearmanr
+import torch
+import torch.distributed as dist
+import yaml
+
+from selene_sdk.samplers.dataloader import _H5Dataset
+from selene_sdk.samplers.dataloader import H5DataLoader
+from selene_sdk.samplers import MultiSampler
+
+from train import LOSS_FN
+from trainer import DDPTrainModel
+from trainer import EpochDistributedSampler
+from utils import init_pretrain_weights
+from utils import load_model_arch
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--config", help="A required .yaml file with training params")
+    parser.add_argument(
+        "--lr", help="Specify a learning rate. Default lr=0.01",
+        type=float, default=0.01)
+    parser.add_argument(
+        "--backend",
+        help="torch.distributed backend, default is nccl with CUDA and gloo "
+             "otherwise",
+        choices=["nccl", "gloo"], default=None)
+    args = parser.parse_args()
+
+    use_cuda = torch.cuda.is_available()
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(
+        backend=args.backend or ("nccl" if use_cuda else "gloo"))
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+
+    setup_args = None
+    with open(args.config) as f:
+        setup_args = yaml.safe_load(f)
+
+    if setup_args['batch_size'] % world_size:
+        raise ValueError("batch_size {0} is not divisible by the {1} "
+                         "processes".format(setup_args['batch_size'],
+                                            world_size))
+    batch_size = setup_args['batch_size'] // world_size
+
+    # all ranks write to the output directory named by rank 0
+    res = ''.join(random.choices(string.ascii_uppercase +
+                                 string.digits, k=8))
+    output_dir = [os.path.join(
+        setup_args['output_dir'],
+        '{0}-{1}'.format(strftime("%Y-%m-%d-%H-%M-%S"), res))]
+    dist.broadcast_object_list(output_dir, src=0)
+    output_dir = output_dir[0]
+    # logs and metrics of the other ranks go to their own subdirectories
+    rank_dir = output_dir if rank == 0 else os.path.join(
+        output_dir, 'rank{0}'.format(rank))
+    os.makedirs(rank_dir, exist_ok=True)
+
+    setup_args['output_dir'] = output_dir
+    setup_args['lr'] = args.lr
+    setup_args['world_size'] = world_size
+    if rank == 0:
+        print(output_dir)
+        config_out = '{0}_lr={1}.yaml'.format(
+            os.path.basename(args.config).rsplit('.', 1)[0], args.lr)
+        print(config_out)
+        with open(os.path.join(output_dir, config_out), 'w') as outfile:
+            yaml.dump(setup_args, outfile)
+
+    # the model is initialized from `seed` on every rank, and the samplers
+    # share it so that the ranks shuffle into disjoint shards; dropout and
+    # the data loader workers draw from per-rank streams seeded from
+    # `rank_seed`
+    seed = setup_args.get("random_seed", 43)
+    rank_seed = seed + rank
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    print("Rank {0} of {1}: setting random seed = {2}, "
+          "rank seed = {3}".format(rank, world_size, seed, rank_seed))
+
+    N_targets = 296
+    targets = np.arange(N_targets)
+
+    if 'seq_len' not in setup_args:
+        setup_args['seq_len'] = 4096
+    if 'n_cpus' not in setup_args:
+        setup_args['n_cpus'] = 1
+    n_cpus = max(1, setup_args['n_cpus'] // world_size)
+
+    valid_file = setup_args.get(
+        'valid_file',
+        "../model/h5_datasets/validate.seqlen=4096.seed=121.N=32000.h5")
+    train_dataset = _H5Dataset(
+        setup_args['train_file'],
+        unpackbits_seq=True,
+        use_seq_len=setup_args['seq_len'])
+    valid_dataset = _H5Dataset(
+        valid_file,
+        unpackbits_seq=True,
+        use_seq_len=setup_args['seq_len'])
+
+    # each rank samples its own shard of the training and validation data
+    train_dl = H5DataLoader(
+        train_dataset,
+        batch_size=batch_size,
+        num_workers=max(1, n_cpus - 1),
+        seed=rank_seed,
+        sampler=EpochDistributedSampler(
+            train_dataset, num_replicas=world_size, rank=rank,
+            shuffle=True, seed=seed),
+        shuffle=False)
+
+    valid_dl = H5DataLoader(
+        valid_dataset,
+        batch_size=batch_size,
+        num_workers=1,
+        seed=rank_seed,
+        sampler=EpochDistributedSampler(
+            valid_dataset, num_replicas=world_size, rank=rank,
+            shuffle=False),
+        shuffle=False)
+
+    multi_sampler = MultiSampler(train_dl, valid_dl, targets)
+
+    model_configs = setup_args['model']
+    if 'class_args' not in model_configs:
+        model_configs['class_args'] = {}
+    # required input arguments to the model architecture class
+    model_configs['class_args']['sequence_length'] = setup_args['seq_len']
+    model_configs['class_args']['n_genomic_features'] = N_targets
+    model, optim, optim_args = load_model_arch(
+        model_configs, lr=args.lr,
+        output_dir=output_dir if rank == 0 else None)
+
+    if 'pretrain' in setup_args and 'checkpoint' not in setup_args:
+        print('Loading pretrain:', setup_args['pretrain'])
+        checkpoint = torch.load(
+             setup_args['pretrain'], map_location=lambda storage, location: storage)
+        model = init_pretrain_weights(
+            model, checkpoint, freeze_upto=setup_args.get('freeze_upto'))
+
+    random.seed(rank_seed)
+    np.random.seed(rank_seed)
+    torch.manual_seed(rank_seed)
+    torch.cuda.manual_seed_all(rank_seed)
+
+    trainer = DDPTrainModel(
+        model,
+        multi_sampler,
+        LOSS_FN[setup_args['loss']],
+        optim, optim_args,
+        batch_size,
+        setup_args.get('max_steps', 1000000),
+        setup_args['report_after_n_steps'],
+        rank_dir,
+        report_gt_feature_n_positives=5,
+        n_validation_samples=setup_args.get('n_validation_samples', 32000),
+        n_test_samples=600000,
+        cpu_n_threads=n_cpus,
+        use_cuda=use_cuda,
+        logging_verbosity=2 if rank == 0 else 0,
+        checkpoint_resume=setup_args.get('checkpoint'),
+        use_scheduler=True,
+        deterministic=True,
+        metrics=dict(spearmanr=spearmanr, pearsonr=pearsonr),
+        precision=setup_args.get('precision', 'fp32'),
+        compare_fp32=setup_args.get('amp_compare_fp32', False)
+    )
+
+    trainer.train_and_validate()
+    dist.destroy_process_group()
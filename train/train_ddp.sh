@@ -0,0 +1,13 @@
+#!/bin/bash
+#SBATCH --time=7-00:00:00
+#SBATCH --partition=gpu
+#SBATCH --gres=gpu:4
+#SBATCH --constraint=a100
+#SBATCH -n 16
+#SBATCH --mem=64000
+#SBATCH --mail-type=ALL
+# notifications go to the submitting user; to use another address, submit
+# with e.g. `sbatch --mail-user="$EMAIL" train_ddp.sh <config>`
+
+torchrun --standalone --nproc_per_node=4 ./train_ddp.py --config=$1 \
+                                                         --lr=0.01
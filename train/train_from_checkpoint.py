@@ -10,21 +10,27 @@ from scipy.stats import spearmanr
 import torch
 import yaml
 
-from selene_sdk.train_model import TrainModel
 from selene_sdk.samplers.dataloader import _H5Dataset
 from selene_sdk.samplers.dataloader import H5DataLoader
 from selene_sdk.samplers import MultiSampler
 from selene_sdk.utils.config_utils import module_from_dir
 from selene_sdk.utils.config_utils import module_from_file
 
+from loss_functions import MaskedMSELoss
+from loss_functions import MaskedPearsonLoss
+from loss_functions import MaskedSpearmanLoss
 from loss_functions import mse
 from loss_functions import spearman_by_track_default
+from trainer import AMPTrainModel
 from utils import load_model_arch
 
 
 LOSS_FN = {
     'mse': mse,
     'spearman_by_track_default': spearman_by_track_default,
+    'masked_mse': MaskedMSELoss(),
+    'pearson_by_track': MaskedPearsonLoss(),
+    'spearman_by_track': MaskedSpearmanLoss(),
 }
 
 
@@ -114,7 +120,7 @@ if __name__ == '__main__':
     model, optim, optim_args = load_model_arch(
         model_configs, lr=args.lr, output_dir=output_dir)
 
-    trainer = TrainModel(
+    trainer = AMPTrainModel(
         model,
         multi_sampler,
         LOSS_FN[setup_args['loss']],
@@ -132,7 +138,9 @@ if __name__ == '__main__':
         use_scheduler=True,
         deterministic=True,
         checkpoint_resume=setup_args['checkpoint'] if 'checkpoint' in setup_args else None,
-        metrics=dict(spearmanr=spearmanr, pearsonr=pearsonr)
+        metrics=dict(spearmanr=spearmanr, pearsonr=pearsonr),
+        precision=setup_args.get('precision', 'fp32'),
+        compare_fp32=setup_args.get('amp_compare_fp32', False)
     )
 
     trainer.train_and_validate()
@@ -0,0 +1,306 @@
+"""
+Mixed precision and distributed training with selene's `TrainModel`.
+`AMPTrainModel` runs the forward pass under autocast ('bf16', or 'fp16' with
+gradient scaling on CUDA), evaluates the loss in float32, and can report
+validation Spearman correlations of the reduced-precision model against
+float32. `DDPTrainModel` trains one process of a `torch.distributed` job.
+"""
+import logging
+from time import time
+import os
+
+import numpy as np
+from scipy.stats import spearmanr
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+from selene_sdk.train_model import TrainModel
+from selene_sdk.utils import load_model_from_state_dict
+
+from utils import autocast
+from utils import resolve_precision
+
+
+logger = logging.getLogger("selene")
+
+
+def amp_step(model, criterion, optimizer, scaler, inputs, targets,
+             precision, device):
+    """
+    One optimization step on a (N, 4, L) batch: the forward pass under
+    autocast at `precision`, the loss in float32 (the soft-rank losses are
+    not stable in reduced precision), and the backward pass and optimizer
+    step through the gradient scaler. Returns the loss.
+    """
+    with autocast(precision, device):
+        predictions = model(inputs)
+    loss = criterion(predictions.float(), targets)
+    optimizer.zero_grad()
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return loss
+
+
+def mean_track_spearman(predictions, targets):
+    """
+    Spearman correlation of each track over its non-NaN targets, averaged
+    over the tracks where it is defined.
+    """
+    corrs = []
+    for t in range(targets.shape[1]):
+        keep = ~np.isnan(targets[:, t])
+        if keep.sum() > 1:
+            corrs.append(spearmanr(predictions[keep, t], targets[keep, t])[0])
+    return float(np.nanmean(corrs)) if corrs else float('nan')
+
+
+class AMPTrainModel(TrainModel):
+    """
+    `TrainModel` with automatic mixed precision.
+
+    Parameters
+    ----------
+    *args, **kwargs
+        `selene_sdk.TrainModel` arguments.
+    precision : str
+        'fp32', 'bf16' or 'fp16' (bf16 on CPU). fp16 training scales the
+        loss with a `torch.amp.GradScaler`, whose state is checkpointed.
+    compare_fp32 : bool
+        At each validation, also predict the validation set in float32 and
+        append the step, the training throughput and both mean by-track
+        validation Spearman correlations to `amp_report.txt`.
+    """
+
+    def __init__(self, *args, precision='fp32', compare_fp32=False,
+                 **kwargs):
+        use_cuda = kwargs.get('use_cuda', False)
+        self._device = torch.device('cuda' if use_cuda else 'cpu')
+        self.precision = resolve_precision(precision, self._device)
+        self.scaler = torch.amp.GradScaler(
+            self._device.type, enabled=self.precision == 'fp16')
+        self._compare_fp32 = compare_fp32 and self.precision != 'fp32'
+        self._n_trained = 0
+        self._train_time = 0.
+        self._last_predictions = None
+        super(AMPTrainModel, self).__init__(*args, **kwargs)
+        if self._compare_fp32:
+            with open(os.path.join(self.output_dir, 'amp_report.txt'),
+                      'a') as report_fh:
+                report_fh.write('step\tprecision\tsequences_per_second\t'
+                                'spearman\tspearman_fp32\n')
+
+    def _load_checkpoint(self, checkpoint_resume):
+        # selene's `TrainModel._load_checkpoint`, also restoring the
+        # gradient scaler from the same `torch.load` of the checkpoint
+        checkpoint = torch.load(
+            checkpoint_resume,
+            map_location=lambda storage, location: storage)
+        if "state_dict" not in checkpoint:
+            raise ValueError(
+                ("'state_dict' not found in file {0} "
+                 "loaded with method `torch.load`. Selene does not support "
+                 "continued training of models that were not originally "
+                 "trained using Selene.").format(checkpoint_resume))
+
+        self.model = load_model_from_state_dict(
+            checkpoint["state_dict"], self.model)
+
+        self._start_step = checkpoint["step"]
+        if self._start_step >= self.max_steps:
+            self.max_steps += self._start_step
+        self.step = self._start_step
+
+        self._min_loss = checkpoint["min_loss"]
+        self.optimizer.load_state_dict(
+            checkpoint["optimizer"])
+        if self.use_cuda:
+            for state in self.optimizer.state.values():
+                for k, v in state.items():
+                    if isinstance(v, torch.Tensor):
+                        state[k] = v.cuda()
+        # a disabled scaler (fp32 or bf16 training) saves an empty state
+        if checkpoint.get('scaler') and self.scaler.is_enabled():
+            self.scaler.load_state_dict(checkpoint['scaler'])
+        if checkpoint.get('precision', self.precision) != self.precision:
+            logger.warning(
+                "Checkpoint was trained at {0} precision, resuming at "
+                "{1}".format(checkpoint['precision'], self.precision))
+
+        logger.info(
+            ("Resuming from checkpoint: step {0}, min loss {1}").format(
+                self._start_step, self._min_loss))
+
+    def _save_checkpoint(self, state, is_best, filename="checkpoint"):
+        state['precision'] = self.precision
+        state['scaler'] = self.scaler.state_dict()
+        super(AMPTrainModel, self)._save_checkpoint(
+            state, is_best, filename=filename)
+
+    def train(self):
+        """
+        Trains the model on a batch of data.
+        """
+        t_i = time()
+        self.model.train()
+        self.sampler.set_mode("train")
+
+        inputs, targets = self._get_batch()
+        inputs = torch.Tensor(inputs).to(self._device, non_blocking=True)
+        targets = torch.Tensor(targets).to(self._device, non_blocking=True)
+        loss = amp_step(self.model, self.criterion, self.optimizer,
+                        self.scaler, inputs.transpose(1, 2), targets,
+                        self.precision, self._device)
+        self._train_loss.append(loss.item())
+        t_f = time()
+
+        self._time_per_step.append(t_f - t_i)
+        self._n_trained += len(inputs)
+        self._train_time += t_f - t_i
+        if self.step and self.step % self.nth_step_report_stats == 0:
+            logger.info("[STEP {0}] average number of steps per second: "
+                        "{1:.1f}".format(self.step,
+                                         1. / np.average(self._time_per_step)))
+            self._train_logger.info(np.average(self._train_loss))
+            logger.info("training loss: {0}".format(
+                np.average(self._train_loss)))
+            self._time_per_step = []
+            self._train_loss = []
+
+    def _evaluate_on_data(self, data_in_batches, precision=None):
+        """
+        Makes predictions for some labeled input data, at `precision`
+        (default is the training precision). Returns the average loss and
+        the predictions.
+        """
+        precision = precision or self.precision
+        self.model.eval()
+        batch_losses = []
+        all_predictions = []
+        for (inputs, targets) in data_in_batches:
+            inputs = torch.Tensor(inputs).to(self._device)
+            targets = torch.Tensor(targets).to(self._device)
+            with torch.no_grad():
+                with autocast(precision, self._device):
+                    predictions = self.model(inputs.transpose(1, 2))
+                predictions = predictions.float()
+                loss = self.criterion(predictions, targets)
+                all_predictions.append(predictions.cpu().numpy())
+                batch_losses.append(loss.item())
+        self._last_predictions = np.vstack(all_predictions)
+        return np.average(batch_losses), self._last_predictions
+
+    def validate(self):
+        """
+        Measures model validation performance and, with `compare_fp32`,
+        reports it against float32.
+        """
+        super(AMPTrainModel, self).validate()
+        if not self._compare_fp32:
+            return
+        predictions = self._last_predictions
+        _, fp32_predictions = self._evaluate_on_data(
+            self._validation_data, precision='fp32')
+        targets = self._all_validation_targets
+        row = [self.step, self.precision,
+               '{0:.1f}'.format(self._n_trained / max(self._train_time, 1e-9)),
+               '{0:.5f}'.format(mean_track_spearman(predictions, targets)),
+               '{0:.5f}'.format(mean_track_spearman(fp32_predictions, targets))]
+        with open(os.path.join(self.output_dir, 'amp_report.txt'),
+                  'a') as report_fh:
+            report_fh.write('\t'.join(str(v) for v in row) + '\n')
+        self._n_trained = 0
+        self._train_time = 0.
+
+
+class EpochDistributedSampler(DistributedSampler):
+    """
+    `DistributedSampler` that advances its epoch, and so reshuffles, each
+    time it is iterated over, as selene's `MultiSampler` restarts its data
+    loaders without calling `set_epoch`.
+    """
+
+    def __iter__(self):
+        indices = super(EpochDistributedSampler, self).__iter__()
+        self.set_epoch(self.epoch + 1)
+        return indices
+
+
+class DDPTrainModel(AMPTrainModel):
+    """
+    `AMPTrainModel` for one process of an initialized `torch.distributed`
+    job (see `train_ddp.py`). The model is wrapped in
+    `DistributedDataParallel`, and the sampler is expected to draw each
+    rank's own shard of the training, validation and test data (see
+    `EpochDistributedSampler`). Each rank predicts its shard of the
+    validation and test sets, and the predictions, targets and losses are
+    gathered so that every rank computes the same metrics, learning rate
+    schedule and early stopping. Only rank 0 saves checkpoints.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The model, on the CPU or the rank's current CUDA device.
+    *args, **kwargs
+        `AMPTrainModel` arguments. `batch_size` is the per-rank batch size,
+        and `n_validation_samples` and `n_test_samples` are totals over all
+        ranks.
+    """
+
+    def __init__(self, model, *args, **kwargs):
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        if kwargs.get('use_cuda', False):
+            device = torch.cuda.current_device()
+            model = DistributedDataParallel(
+                model.cuda(device), device_ids=[device])
+        else:
+            model = DistributedDataParallel(model)
+        kwargs['data_parallel'] = False
+        super(DDPTrainModel, self).__init__(model, *args, **kwargs)
+
+    def _gather(self, array):
+        # rows of every rank in rank order; all ranks have the same shape
+        tensor = torch.from_numpy(np.ascontiguousarray(array)).to(
+            self._device)
+        gathered = [torch.empty_like(tensor) for _ in range(self.world_size)]
+        dist.all_gather(gathered, tensor)
+        return torch.cat(gathered).cpu().numpy()
+
+    def _create_validation_set(self, n_samples=None):
+        if n_samples is None:
+            n_samples = 32000
+        super(DDPTrainModel, self)._create_validation_set(
+            n_samples=n_samples // self.world_size)
+        self._all_validation_targets = self._gather(
+            self._all_validation_targets)
+
+    def create_test_set(self):
+        """
+        Loads each rank's shard of the test set, and gathers its targets.
+        """
+        n_samples = self._n_test_samples
+        if n_samples is None:
+            n_samples = 640000
+        self._test_data, targets = self.sampler.get_test_set(
+            self.batch_size, n_samples=n_samples // self.world_size)
+        self._all_test_targets = self._gather(targets)
+        if self.rank == 0:
+            np.savez_compressed(
+                os.path.join(self.output_dir, "test_targets.npz"),
+                data=self._all_test_targets)
+
+    def _evaluate_on_data(self, data_in_batches, precision=None):
+        loss, predictions = super(DDPTrainModel, self)._evaluate_on_data(
+            data_in_batches, precision=precision)
+        loss = torch.tensor(loss, dtype=torch.float64, device=self._device)
+        dist.all_reduce(loss)
+        self._last_predictions = self._gather(predictions)
+        return loss.item() / self.world_size, self._last_predictions
+
+    def _save_checkpoint(self, state, is_best, filename="checkpoint"):
+        if self.rank == 0:
+            super(DDPTrainModel, self)._save_checkpoint(
+                state, is_best, filename=filename)
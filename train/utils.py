@@ -1,4 +1,6 @@
 from collections import OrderedDict
+from contextlib import nullcontext
+import json
 from shutil import copyfile
 from shutil import copytree
 import os
@@ -10,11 +12,40 @@ from selene_sdk.utils import NonStrandSpecific
 from selene_sdk.utils.config_utils import module_from_dir
 from selene_sdk.utils.config_utils import module_from_file
 
+# packbits decoding is shared with ../eval, ../interpret and ../predict
+from packbits import decode_packbits
+from packbits import PackedInputModel
+from packbits import unpackbits_sequence
+
+
+# model file or directory path -> module loaded from it
+_MODEL_MODULES = {}
+
+
+def load_model_module(model_configs):
+    """
+    Load the module that defines the model architecture in `model_configs`.
+    Each path is loaded once, so helpers taken from the returned module
+    (e.g. `quantize_for_cpu` in `../model/wreath.py`) recognize the classes
+    of models built by `load_model_arch`.
+    """
+    import_model_from = model_configs["path"].rstrip(os.sep)
+    if import_model_from not in _MODEL_MODULES:
+        if os.path.isdir(import_model_from):
+            module = module_from_dir(import_model_from)
+        else:
+            module = module_from_file(import_model_from)
+        _MODEL_MODULES[import_model_from] = module
+    return _MODEL_MODULES[import_model_from]
+
 
 def load_model_arch(model_configs, lr=None, output_dir=None):
     """
     Load model architecture from config file specifications.
-    Wrap with NonStrandSpecific.
+    Wrap with NonStrandSpecific, or with `non_strand_specific: batched`
+    in `model_configs`, let the model average the two strands itself in a
+    single forward pass (requires a `strand_average` class argument, e.g.
+    `Wreath`). `non_strand_specific: none` predicts the forward strand only.
 
     If `lr` and `output_dir` are not None, assume model is
     in training mode and save the model file to the
@@ -23,24 +54,27 @@ def load_model_arch(model_configs, lr=None, output_dir=None):
     import_model_from = model_configs["path"]
     model_class_name = model_configs["class"]
 
-    module = None
+    module = load_model_module(model_configs)
     if os.path.isdir(import_model_from):
         import_model_from = import_model_from.rstrip(os.sep)
-        module = module_from_dir(import_model_from)
         if output_dir:
             copytree(
                 import_model_from,
                 os.path.join(output_dir, os.path.basename(import_model_from)))
     else:
-        module = module_from_file(import_model_from)
         if output_dir:
             copyfile(
                 import_model_from,
                 os.path.join(output_dir, os.path.basename(import_model_from)))
     model_class = getattr(module, model_class_name)
-    model = model_class(**model_configs["class_args"])
-    model = NonStrandSpecific(
-        model, mode='mean')
+    strand_mode = model_configs.get("non_strand_specific", "mean")
+    class_args = dict(model_configs["class_args"])
+    if strand_mode == "batched":
+        class_args["strand_average"] = True
+    model = model_class(**class_args)
+    if strand_mode not in ("batched", "none"):
+        model = NonStrandSpecific(
+            model, mode=strand_mode)
     if lr:
         optim_class, optim_kwargs = module.get_optimizer(lr)
         return model, optim_class, optim_kwargs
@@ -111,14 +145,79 @@ def init_weights(model, checkpoint):
     return model
 
 
-def unpackbits_sequence(sequence, s_len):
-    sequence = np.unpackbits(sequence.astype(np.uint8), axis=-2)
-    nulls = np.sum(sequence, axis=-1) == sequence.shape[-1]
-    sequence = sequence.astype(float)
-    sequence[nulls, :] = 1.0 / sequence.shape[-1]
-    if sequence.ndim == 3:
-        sequence = sequence[:, :s_len, :]
-    else:
-        sequence = sequence[:s_len, :]
-    return sequence
+# name of the metadata file stored in exported model artifacts
+EXPORT_METADATA = 'wreath_export.json'
+
+
+def load_exported_model(path, device=None):
+    """
+    Load a TorchScript model artifact written by `../eval/export_model.py`.
+
+    Returns the TorchScript module in eval mode, on `device` if given, and
+    its export metadata: `seq_len`, `n_targets`, `strand_mode`, `precision`
+    and `dtype`, the torch dtype name inputs must be cast to.
+    """
+    extra_files = {EXPORT_METADATA: ''}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    metadata = json.loads(extra_files[EXPORT_METADATA])
+    return model.eval(), metadata
+
 
+def load_onnx_session(path, intra_op_threads=None):
+    """
+    Create a CPU onnxruntime session for an ONNX model written by
+    `../eval/export_model.py --format=onnx`, with all graph optimizations
+    enabled and `intra_op_threads` threads per operator (onnxruntime's
+    default if None).
+
+    Returns the session and the export metadata (see `load_exported_model`).
+    Run it with `session.run(None, {'sequence': x})[0]` where `x` is a
+    numpy array of shape (N, 4, seq_len) and dtype `metadata['dtype']`.
+    """
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = \
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    session = onnxruntime.InferenceSession(
+        path, sess_options=options, providers=['CPUExecutionProvider'])
+    metadata = json.loads(
+        session.get_modelmeta().custom_metadata_map[EXPORT_METADATA])
+    return session, metadata
+
+
+# --precision choice -> (autocast dtype, dtype predictions are stored in)
+PRECISIONS = {
+    'fp32': (None, np.float32),
+    'bf16': (torch.bfloat16, np.float16),
+    'fp16': (torch.float16, np.float16),
+}
+
+
+def resolve_precision(precision, device, verbose=True):
+    """
+    The precision autocast runs at on `device`: fp16 is CUDA-only, so on
+    CPU 'fp16' becomes 'bf16' (announced unless `verbose` is False).
+    Resolve the precision once before running batches under `autocast`.
+    """
+    if precision == 'fp16' and torch.device(device).type == 'cpu':
+        if verbose:
+            print("fp16 autocast is not supported on CPU, using bf16")
+        return 'bf16'
+    return precision
+
+
+def autocast(precision, device):
+    """
+    Autocast context for running a model at `precision` ('fp32', 'bf16' or
+    'fp16') on `device`, resolved with `resolve_precision`. bfloat16
+    predictions are stored as float16, which represents values in [0, 1]
+    at least as precisely, since HDF5 and numpy have no bfloat16 type.
+    """
+    precision = resolve_precision(precision, device, verbose=False)
+    dtype, _ = PRECISIONS[precision]
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)